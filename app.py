@@ -1,10 +1,29 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, Response, stream_with_context, g
 import sqlite3
 import os
 import requests
 from datetime import timedelta
 import json
+import threading
+import time
+from ollama_client import OllamaClient, OllamaLoadBalancer, pack_context, unpack_context
+from db import Database
+from migrations import migrate, format_session_preview
+from conversation import ConversationWindow, estimate_tokens
+from response_cache import ResponseCache
+from semantic_cache import SemanticCache
+from singleflight import SingleFlight
+from health_monitor import HealthMonitor
+from model_warmer import ModelWarmer, model_name
+from model_router import ModelRouter
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from scheduler import GenerationScheduler, QueueFullError
+from jobs import ChatJobQueue, JobQueueFullError
+from rate_limit import RateLimiter
+from passwords import PasswordHasher, PasswordHasherBusy
+from write_behind import WriteBehindBuffer
+from search import search_messages
+import metrics
 
 # Import configuration
 try:
@@ -16,9 +35,66 @@ except ImportError:
     FLASK_DEBUG = True
     SECRET_KEY = "your-secret-key-here-change-in-production"
     DATABASE_NAME = "chatapp.db"
+    DATABASE_BUSY_TIMEOUT_MS = 5000
     OLLAMA_URL = "http://localhost:11434"
     OLLAMA_MODEL = "llama3.2:1b-instruct-q4_K_M"
     OLLAMA_TIMEOUT = 30
+    OLLAMA_CONNECT_TIMEOUT = 3
+    OLLAMA_TOTAL_TIMEOUT = 120
+    OLLAMA_POOL_SIZE = 10
+    OLLAMA_MAX_RETRIES = 2
+    OLLAMA_URLS = [OLLAMA_URL]
+    OLLAMA_BACKEND_MAX_FAILURES = 3
+    OLLAMA_BACKEND_EJECT_SECONDS = 30
+    OLLAMA_BREAKER_FAILURE_THRESHOLD = 5
+    OLLAMA_BREAKER_RESET_SECONDS = 30
+    OLLAMA_WARM_MODELS = []
+    OLLAMA_KEEP_ALIVE_MIN_SECONDS = 300
+    OLLAMA_KEEP_ALIVE_MAX_SECONDS = 3600
+    OLLAMA_WARM_CHECK_INTERVAL = 60
+    OLLAMA_ROUTED_MODELS = []
+    OLLAMA_ROUTER_MAX_QUEUE_DEPTH = 0
+    OLLAMA_ROUTER_LATENCY_BUDGET_SECONDS = 30
+    GENERATION_MAX_CONCURRENT = 4
+    GENERATION_MAX_QUEUE = 16
+    CHAT_JOB_WORKERS = 4
+    CHAT_JOB_MAX_PENDING = 100
+    CHAT_JOB_MAX_WAIT_SECONDS = 30
+    CHAT_SAVE_PARTIAL_REPLIES = True
+    RATE_LIMIT_ENABLED = True
+    RATE_LIMIT_DATABASE = "ratelimit.db"
+    RATE_LIMIT_SYNC_SECONDS = 1.0
+    RATE_LIMITS = {
+        'chat': {'user': (10, 20), 'ip': (30, 60)},
+        'auth': {'user': (5, 5), 'ip': (20, 20)},
+    }
+    PASSWORD_HASH_METHOD = "scrypt:32768:8:1"
+    PASSWORD_HASH_WORKERS = 2
+    PASSWORD_HASH_MAX_PENDING = 16
+    CHAT_WRITE_BEHIND_ENABLED = False
+    CHAT_WRITE_BEHIND_DURABILITY = "group"
+    CHAT_WRITE_BEHIND_SYNCHRONOUS = None
+    CHAT_WRITE_BEHIND_MAX_BATCH = 64
+    CHAT_WRITE_BEHIND_MAX_DELAY_MS = 20
+    OLLAMA_HEALTH_INTERVAL = 15
+    HEALTH_EVENTS_MAX_SUBSCRIBERS = 0
+    HEALTH_EVENTS_MAX_SECONDS = 300
+    CONVERSATION_TOKEN_BUDGET = 1500
+    CONVERSATION_SUMMARY_MIN_TURNS = 4
+    RESPONSE_CACHE_ENABLED = True
+    RESPONSE_CACHE_MEMORY_ENTRIES = 1000
+    RESPONSE_CACHE_MAX_ENTRIES = 10000
+    RESPONSE_CACHE_TTL_SECONDS = 86400
+    SEMANTIC_CACHE_ENABLED = False
+    SEMANTIC_CACHE_MODEL = "nomic-embed-text"
+    SEMANTIC_CACHE_THRESHOLD = 0.95
+    SEMANTIC_CACHE_MAX_ENTRIES = 5000
+    SEMANTIC_CACHE_MAX_MEMORY_MB = 64
+    CHAT_HISTORY_PAGE_SIZE = 50
+    CHAT_HISTORY_MAX_PAGE_SIZE = 200
+    SEARCH_PAGE_SIZE = 20
+    SEARCH_MAX_PAGE_SIZE = 100
+    SEARCH_MAX_RESULTS = 500
     SESSION_LIFETIME_HOURS = 1
     APP_NAME = "AI Chat App"
     APP_TITLE = "🤖 AI Chat Assistant"
@@ -28,112 +104,145 @@ app = Flask(__name__)
 app.secret_key = SECRET_KEY
 app.permanent_session_lifetime = timedelta(hours=SESSION_LIFETIME_HOURS)
 
+# Per-thread SQLite connections shared by all helpers and routes
+db = Database(DATABASE_NAME, busy_timeout_ms=DATABASE_BUSY_TIMEOUT_MS)
+
+# Fails Ollama calls fast after repeated errors instead of waiting out timeouts
+ollama_breaker = CircuitBreaker(failure_threshold=OLLAMA_BREAKER_FAILURE_THRESHOLD,
+                                reset_timeout=OLLAMA_BREAKER_RESET_SECONDS)
+
+# Token buckets per user and IP, in their own database shared by all processes
+rate_limiter = RateLimiter(Database(RATE_LIMIT_DATABASE, busy_timeout_ms=DATABASE_BUSY_TIMEOUT_MS), RATE_LIMITS,
+                           sync_interval=RATE_LIMIT_SYNC_SECONDS)
+
+# Password hashing runs in worker processes so logins don't stall chat threads
+password_hasher = PasswordHasher(method=PASSWORD_HASH_METHOD, workers=PASSWORD_HASH_WORKERS,
+                                 max_pending=PASSWORD_HASH_MAX_PENDING)
+
+# Shared keep-alive clients for all Ollama calls in this process, one per server
+ollama = OllamaLoadBalancer([
+    OllamaClient(url,
+                 pool_size=OLLAMA_POOL_SIZE,
+                 connect_timeout=OLLAMA_CONNECT_TIMEOUT,
+                 first_byte_timeout=OLLAMA_TIMEOUT,
+                 total_timeout=OLLAMA_TOTAL_TIMEOUT,
+                 max_retries=OLLAMA_MAX_RETRIES)
+    for url in OLLAMA_URLS
+], max_failures=OLLAMA_BACKEND_MAX_FAILURES, eject_seconds=OLLAMA_BACKEND_EJECT_SECONDS,
+   breaker=ollama_breaker)
+
+# Batches chat turn writes into group commits when write-behind is enabled
+chat_writer = WriteBehindBuffer(db, max_batch=CHAT_WRITE_BEHIND_MAX_BATCH,
+                                max_delay=CHAT_WRITE_BEHIND_MAX_DELAY_MS / 1000,
+                                synchronous=CHAT_WRITE_BEHIND_SYNCHRONOUS)
+
+# Preloads the chat model (and OLLAMA_WARM_MODELS) and picks keep_alive from recent traffic
+model_warmer = ModelWarmer(ollama, OLLAMA_MODEL, warm_models=OLLAMA_WARM_MODELS,
+                           min_keep_alive=OLLAMA_KEEP_ALIVE_MIN_SECONDS,
+                           max_keep_alive=OLLAMA_KEEP_ALIVE_MAX_SECONDS,
+                           interval=OLLAMA_WARM_CHECK_INTERVAL)
+
+# Caps concurrent generations and queues the rest fairly across users
+generation_scheduler = GenerationScheduler(max_concurrent=GENERATION_MAX_CONCURRENT,
+                                           max_queue=GENERATION_MAX_QUEUE)
+
+# Sends long or hard messages to larger models while the queue and their speed allow it
+model_router = ModelRouter(OLLAMA_MODEL, OLLAMA_ROUTED_MODELS,
+                           queue_depth=generation_scheduler.queue_depth,
+                           max_queue_depth=OLLAMA_ROUTER_MAX_QUEUE_DEPTH,
+                           latency_budget=OLLAMA_ROUTER_LATENCY_BUDGET_SECONDS)
+
+# Multi-turn prompts for sessions without a reusable Ollama context
+conversation = ConversationWindow(db, ollama, OLLAMA_MODEL,
+                                  token_budget=CONVERSATION_TOKEN_BUDGET,
+                                  summary_min_turns=CONVERSATION_SUMMARY_MIN_TURNS,
+                                  keep_alive=model_warmer.keep_alive,
+                                  slot=generation_scheduler.slot)
+
+# Exact-match reply cache (in-process LRU backed by a table shared across workers)
+response_cache = ResponseCache(db,
+                               max_memory_entries=RESPONSE_CACHE_MEMORY_ENTRIES,
+                               max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                               ttl_seconds=RESPONSE_CACHE_TTL_SECONDS)
+
+# Paraphrase-tolerant tier behind the exact-match cache (per process)
+semantic_cache = SemanticCache(ollama, SEMANTIC_CACHE_MODEL,
+                               threshold=SEMANTIC_CACHE_THRESHOLD,
+                               max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+                               max_memory_mb=SEMANTIC_CACHE_MAX_MEMORY_MB,
+                               ttl_seconds=RESPONSE_CACHE_TTL_SECONDS,
+                               slot=generation_scheduler.slot)
+
+# Identical concurrent generations share one upstream request
+generation_flights = SingleFlight()
+
 # Database initialization
 def init_db():
     """Initialize SQLite database"""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    
-    # Create users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            phone TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Create chat sessions table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS chat_sessions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            title TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Create chat history table (updated with session_id)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS chat_messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id INTEGER,
-            user_id INTEGER,
-            message TEXT NOT NULL,
-            response TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (session_id) REFERENCES chat_sessions (id),
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Migration: Add session_id column if it doesn't exist
-    try:
-        cursor.execute("PRAGMA table_info(chat_messages)")
-        columns = cursor.fetchall()
-        column_names = [col[1] for col in columns]
-        
-        if 'session_id' not in column_names:
-            print("🔄 Migrating database: Adding session_id column...")
-            cursor.execute('ALTER TABLE chat_messages ADD COLUMN session_id INTEGER')
-            
-            # For existing messages, create default sessions
-            cursor.execute('SELECT DISTINCT user_id FROM chat_messages WHERE session_id IS NULL')
-            users_with_messages = cursor.fetchall()
-            
-            for (user_id,) in users_with_messages:
-                cursor.execute('''
-                    INSERT INTO chat_sessions (user_id, title, created_at, updated_at)
-                    VALUES (?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-                ''', (user_id, 'Migrated Chat'))
-                
-                session_id = cursor.lastrowid
-                cursor.execute('''
-                    UPDATE chat_messages 
-                    SET session_id = ? 
-                    WHERE user_id = ? AND session_id IS NULL
-                ''', (session_id, user_id))
-            
-            print("✅ Database migration completed!")
-    except Exception as e:
-        print(f"Migration check failed: {e}")
-    
-    conn.commit()
-    conn.close()
+    migrate(db)
 
 # Ollama integration functions
-def get_ai_response(message):
-    """Get response from Ollama AI model"""
+def falls_back_to_default(response, model, context):
+    """True if Ollama doesn't have a routed model and OLLAMA_MODEL should answer instead
+    
+    Only prompts without a context fall back: they stand alone, so the default
+    model can answer them. The model is then taken out of routing for a while.
+    """
+    if response.status_code != 404 or model == OLLAMA_MODEL or context:
+        return False
+    model_router.mark_unavailable(model)
+    return True
+
+def get_ai_response(message, context=None, result=None, user_id=None, model=None):
+    """Get response from Ollama AI model
+    
+    context is the token array from a previous turn; when given, Ollama skips
+    re-evaluating that prefix. If result is a dict, it receives Ollama's final
+    response fields (new context, token counts and durations) and the model
+    that answered. The call waits for a generation slot in user_id's turn.
+    model defaults to OLLAMA_MODEL; a routed model that isn't installed falls
+    back to it. A full generation queue (QueueFullError) or open circuit
+    (CircuitOpenError) is raised for the route to answer with 429/503; other
+    failures come back as the reply text.
+    """
+    model = model or OLLAMA_MODEL
     try:
-        ollama_url = f"{OLLAMA_URL}/api/generate"
-        
         payload = {
-            "model": OLLAMA_MODEL,
+            "model": model,
             "prompt": message,
-            "stream": False
+            "stream": False,
+            "keep_alive": model_warmer.keep_alive()
         }
+        model_warmer.record_request()
+        if context:
+            payload["context"] = context
         
-        print(f"🤖 Sending request to Ollama: {ollama_url}")
-        print(f"📝 Model: {OLLAMA_MODEL}")
+        print(f"🤖 Sending request to Ollama: {ollama.base_url}")
+        print(f"📝 Model: {model}")
         
-        response = requests.post(ollama_url, json=payload, timeout=OLLAMA_TIMEOUT)
+        with generation_scheduler.slot(user_id):
+            started = time.perf_counter()
+            response = ollama.generate(payload)
         
         if response.status_code == 200:
             data = response.json()
             ai_response = data.get('response', 'No response from AI model.')
             print(f"✅ AI Response received: {len(ai_response)} characters")
+            model_router.record(model, data)
+            metrics.observe_generation(model, data, time.perf_counter() - started)
+            if result is not None:
+                result.update(data, model=model)
             return ai_response
+        elif falls_back_to_default(response, model, context):
+            return get_ai_response(message, result=result, user_id=user_id)
         elif response.status_code == 404:
-            return f"❌ Model '{OLLAMA_MODEL}' not found. Please run the setup script to install the model."
+            return f"❌ Model '{model}' not found. Please run the setup script to install the model."
         else:
             print(f"❌ Ollama API error: {response.status_code} - {response.text}")
             return f"AI service error (HTTP {response.status_code}). Please check if the model is available."
             
+    except (CircuitOpenError, QueueFullError):
+        raise
     except requests.exceptions.ConnectionError as e:
         print(f"❌ Connection error: {e}")
         return "🔌 Unable to connect to AI service. Please start Ollama with Docker using 'docker-compose up -d ollama'."
@@ -144,154 +253,496 @@ def get_ai_response(message):
         print(f"❌ Unexpected error: {e}")
         return f"❌ Error communicating with AI service: {str(e)}"
 
-def check_ollama_health():
-    """Check if Ollama service is healthy"""
+def stream_ai_response(message, context=None, result=None, user_id=None, model=None):
+    """Stream response tokens from Ollama AI model as they are generated
+    
+    context, result and model work as in get_ai_response(); result is filled
+    in once the final chunk arrives. QueueFullError and CircuitOpenError are
+    raised before the first token.
+    """
+    model = model or OLLAMA_MODEL
     try:
-        response = requests.get(f"{OLLAMA_URL}/api/tags", timeout=5)
-        if response.status_code == 200:
-            data = response.json()
-            models = data.get('models', [])
-            has_required_model = any(model.get('name') == OLLAMA_MODEL for model in models)
-            return {
-                'status': 'healthy',
-                'models_available': len(models),
-                'required_model_available': has_required_model,
-                'models': [model.get('name') for model in models]
-            }
-        return {'status': 'unhealthy', 'error': 'Service unavailable'}
+        payload = {
+            "model": model,
+            "prompt": message,
+            "stream": True,
+            "keep_alive": model_warmer.keep_alive()
+        }
+        model_warmer.record_request()
+        if context:
+            payload["context"] = context
+        
+        print(f"🤖 Streaming request to Ollama: {ollama.base_url}")
+        print(f"📝 Model: {model}")
+        
+        # The slot is held until the stream has been read to the end
+        with generation_scheduler.slot(user_id):
+            started = time.perf_counter()
+            response = ollama.stream_generate(payload)
+            if not falls_back_to_default(response, model, context):
+                yield from read_stream(response, model, result, started)
+                return
+            response.close()
+        
+        # Retried once this slot is released, since the fallback waits for a slot of its own
+        yield from stream_ai_response(message, result=result, user_id=user_id)
+                
+    except (CircuitOpenError, QueueFullError):
+        raise
+    except requests.exceptions.ConnectionError as e:
+        print(f"❌ Connection error: {e}")
+        yield "🔌 Unable to connect to AI service. Please start Ollama with Docker using 'docker-compose up -d ollama'."
+    except requests.exceptions.Timeout as e:
+        print(f"⏱️ Timeout error: {e}")
+        yield "⏱️ AI service is taking too long to respond. The model might be loading. Please try again in a moment."
     except Exception as e:
-        return {'status': 'unhealthy', 'error': str(e)}
+        print(f"❌ Unexpected error: {e}")
+        yield f"❌ Error communicating with AI service: {str(e)}"
 
-# Session management functions
-def get_or_create_default_session(user_id):
-    """Get or create a default chat session for user"""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
+def read_stream(response, model, result=None, started=None):
+    """Yield the reply tokens of a streaming Ollama response, closing it at the end
     
-    # Try to get existing default session
-    cursor.execute('''
-        SELECT id FROM chat_sessions 
-        WHERE user_id = ? 
-        ORDER BY created_at DESC 
-        LIMIT 1
-    ''', (user_id,))
+    started is the perf_counter() time the request was sent, for /metrics.
+    """
+    started = time.perf_counter() if started is None else started
+    first_token = None
+    if response.status_code == 404:
+        response.close()
+        yield f"❌ Model '{model}' not found. Please run the setup script to install the model."
+        return
+    if response.status_code != 200:
+        print(f"❌ Ollama API error: {response.status_code} - {response.text}")
+        response.close()
+        yield f"AI service error (HTTP {response.status_code}). Please check if the model is available."
+        return
+    
+    # Ollama sends one JSON object per line until "done" is true
+    chunks = ollama.iter_chunks(response)
+    try:
+        for chunk in chunks:
+            if chunk.get('error'):
+                print(f"❌ Ollama stream error: {chunk['error']}")
+                metrics.count_error('ollama', 'StreamError')
+                yield f"❌ Error communicating with AI service: {chunk['error']}"
+                return
+            token = chunk.get('response', '')
+            if token:
+                if first_token is None:
+                    first_token = time.perf_counter() - started
+                yield token
+            if chunk.get('done'):
+                print("✅ AI stream completed")
+                elapsed = time.perf_counter() - started
+                model_router.record(model, chunk)
+                metrics.observe_generation(model, chunk, elapsed,
+                                           ttft=elapsed if first_token is None else first_token)
+                if result is not None:
+                    result.update(chunk, model=model)
+                return
+    finally:
+        # Closes the connection if we stop early, which makes Ollama abort the generation
+        chunks.close()
+
+def lookup_cached_response(prompt, context=None, bypass=False, model=None, semantic=False, user_id=None):
+    """Return (cache key, cached reply) for a prompt
+    
+    The key is None when the request can't be cached: with a KV context the
+    conversation state isn't part of the prompt text. The same key is used
+    to coalesce identical in-flight generations. Exact misses fall back to
+    the semantic cache when it is enabled and semantic is true, which callers
+    only pass for a standalone message: prompts that carry a session's
+    transcript embed alike whatever the new question is.
+    """
+    if not RESPONSE_CACHE_ENABLED or context:
+        return None, None
+    key = response_cache.make_key(prompt, model or OLLAMA_MODEL)
+    cached = response_cache.get(key, bypass=bypass)
+    if cached is None and SEMANTIC_CACHE_ENABLED and semantic and not bypass:
+        cached = semantic_cache.get(prompt, model or OLLAMA_MODEL, user_id)
+    return key, cached
+
+def store_cached_response(key, prompt, reply, semantic=False, model=None, user_id=None):
+    """Cache a reply model generated in every enabled tier (semantic only if standalone)"""
+    response_cache.put(key, reply)
+    if SEMANTIC_CACHE_ENABLED and semantic:
+        semantic_cache.put(prompt, reply, model or OLLAMA_MODEL, user_id)
+
+def get_cached_ai_response(prompt, context=None, result=None, bypass_cache=False, user_id=None, model=None,
+                           standalone=False):
+    """Get a reply from model's response cache, generating it on a miss
+    
+    standalone means prompt is just the user's message, with no history added.
+    """
+    result = {} if result is None else result
+    key, cached = lookup_cached_response(prompt, context, bypass_cache, model, standalone, user_id)
+    if cached is not None:
+        print(f"⚡ Cache hit for prompt ({len(cached)} characters)")
+        result['cached'] = True
+        return cached
+    
+    if not key:
+        return get_ai_response(prompt, context=context, result=result, user_id=user_id, model=model)
     
-    session_row = cursor.fetchone()
+    # Wait on an identical in-flight generation instead of starting another
+    def generate(flight_result):
+        ai_response = get_ai_response(prompt, context=context, result=flight_result, user_id=user_id, model=model)
+        # Only successful generations are cached (by the model that was asked), never error messages
+        if flight_result.get('done') and flight_result['model'] == (model or OLLAMA_MODEL):
+            store_cached_response(key, prompt, ai_response, standalone, model, user_id)
+        return ai_response
     
-    if session_row:
-        session_id = session_row[0]
+    return generation_flights.call(key, generate, result)
+
+def stream_reply(prompt, context=None, result=None, bypass_cache=False, user_id=None, model=None,
+                 standalone=False):
+    """Yield reply tokens from the cache, an identical in-flight generation or Ollama
+    
+    Closing the generator early cancels the Ollama request unless other
+    requests are waiting on the same generation. standalone is as in
+    get_cached_ai_response().
+    """
+    result = {} if result is None else result
+    key, cached = lookup_cached_response(prompt, context, bypass_cache, model, standalone, user_id)
+    if cached is not None:
+        # A cache hit is sent as one token
+        result['cached'] = True
+        yield cached
+    elif key:
+        # Followers of an identical in-flight generation replay its tokens
+        yield from generation_flights.stream(
+            key, lambda flight_result: cache_stream(key, prompt, flight_result, user_id, model, standalone), result)
     else:
-        # Create new default session
+        yield from stream_ai_response(prompt, context=context, result=result, user_id=user_id, model=model)
+
+def cache_stream(key, prompt, result, user_id=None, model=None, standalone=False):
+    """Stream a cacheable generation and store it once it completes successfully"""
+    tokens = []
+    for token in stream_ai_response(prompt, result=result, user_id=user_id, model=model):
+        tokens.append(token)
+        yield token
+    if result.get('done') and result['model'] == (model or OLLAMA_MODEL):
+        store_cached_response(key, prompt, ''.join(tokens), standalone, model, user_id)
+
+def check_ollama_health():
+    """Check if Ollama service is healthy (probing every configured server)"""
+    backends = ollama.probe_backends(timeout=(OLLAMA_CONNECT_TIMEOUT, 5))
+    healthy = [backend for backend in backends if backend['healthy']]
+    if not healthy:
+        return {'status': 'unhealthy', 'error': 'Service unavailable', 'backends': backends}
+
+    models = sorted({name for backend in healthy for name in backend['models']})
+    # Available means installed; loaded means in memory, so requests skip the load time
+    loaded = sorted({name for backend in healthy for name in backend['loaded']})
+    return {
+        'status': 'healthy',
+        'models_available': len(models),
+        'required_model_available': OLLAMA_MODEL in models,
+        'required_model_loaded': model_name(OLLAMA_MODEL) in {model_name(name) for name in loaded},
+        'models': models,
+        'models_loaded': loaded,
+        'backends': backends
+    }
+
+def ollama_unavailable(error=None):
+    """503 response for chat requests while the Ollama circuit (or error's) is open"""
+    retry_after = error.retry_after if error else ollama_breaker.retry_after()
+    return jsonify({
+        'error': f'AI service is temporarily unavailable. Please try again in {retry_after} seconds.',
+        'retry_after': retry_after
+    }), 503, {'Retry-After': str(retry_after)}
+
+def generation_queue_full(error):
+    """429 response for chat requests when the generation queue is full"""
+    return jsonify({
+        'error': f'AI service is busy. Please try again in {error.estimated_wait} seconds.',
+        'queue_position': error.position,
+        'estimated_wait': error.estimated_wait
+    }), 429, {'Retry-After': str(error.estimated_wait)}
+
+def rate_limit_exceeded(route_class, user=None):
+    """Take a token for this request; return the decision if it is over its limit
+    
+    user identifies the account (or the attempted login); the client IP is
+    always checked as well. The decision's headers are added to the response.
+    """
+    if not RATE_LIMIT_ENABLED:
+        return None
+    decision = rate_limiter.check(route_class, user=user, ip=request.remote_addr)
+    if decision is None:
+        return None
+    g.rate_limit = decision
+    return None if decision.allowed else decision
+
+def too_many_requests(decision):
+    """429 response for a request that is over its rate limit"""
+    return jsonify({
+        'error': f'Too many requests. Please try again in {decision.retry_after} seconds.',
+        'retry_after': decision.retry_after
+    }), 429
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_request_duration(response):
+    """Time each request for /metrics once its body has been sent, so streams count in full"""
+    started = g.get('request_started')
+    if started is not None:
+        labels = (request.method, request.url_rule.rule if request.url_rule else 'unmatched',
+                  str(response.status_code))
+        response.call_on_close(
+            lambda: metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, *labels))
+    return response
+
+@app.teardown_request
+def count_request_error(error):
+    """Count unhandled exceptions for /metrics"""
+    if error is not None:
+        metrics.count_error('http', error)
+
+@app.after_request
+def add_rate_limit_headers(response):
+    """Attach X-RateLimit-* (and Retry-After) headers for rate-limited routes"""
+    decision = g.get('rate_limit')
+    if decision is not None:
+        response.headers.update(decision.headers())
+    return response
+
+# Probes Ollama in the background; health requests read its latest snapshot
+health_monitor = HealthMonitor(check_ollama_health, interval=OLLAMA_HEALTH_INTERVAL)
+health_event_slots = threading.BoundedSemaphore(HEALTH_EVENTS_MAX_SUBSCRIBERS)
+
+# Session management functions
+def get_or_create_default_session(user_id):
+    """Get or create a default chat session for user"""
+    with db.transaction() as cursor:
+        # Try to get existing default session
         cursor.execute('''
-            INSERT INTO chat_sessions (user_id, title)
-            VALUES (?, ?)
-        ''', (user_id, 'New Chat'))
-        session_id = cursor.lastrowid
+            SELECT id FROM chat_sessions 
+            WHERE user_id = ? 
+            ORDER BY created_at DESC 
+            LIMIT 1
+        ''', (user_id,))
+        
+        session_row = cursor.fetchone()
+        
+        if session_row:
+            session_id = session_row[0]
+        else:
+            # Create new default session
+            cursor.execute('''
+                INSERT INTO chat_sessions (user_id, title)
+                VALUES (?, ?)
+            ''', (user_id, 'New Chat'))
+            session_id = cursor.lastrowid
     
-    conn.commit()
-    conn.close()
     return session_id
 
 def verify_session_ownership(session_id, user_id):
     """Verify that a session belongs to the user"""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
+    result = db.query_one('''
         SELECT id FROM chat_sessions 
         WHERE id = ? AND user_id = ?
     ''', (session_id, user_id))
     
-    result = cursor.fetchone()
-    conn.close()
     return result is not None
 
 def create_new_session(user_id, title="New Chat"):
     """Create a new chat session"""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO chat_sessions (user_id, title)
-        VALUES (?, ?)
-    ''', (user_id, title))
-    
-    session_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with db.transaction() as cursor:
+        cursor.execute('''
+            INSERT INTO chat_sessions (user_id, title)
+            VALUES (?, ?)
+        ''', (user_id, title))
+        
+        session_id = cursor.lastrowid
     return session_id
 
 def get_user_sessions(user_id):
     """Get all chat sessions for a user with recent message preview"""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT s.id, s.title, s.created_at, s.updated_at,
-               (SELECT COUNT(*) FROM chat_messages WHERE session_id = s.id) as message_count,
-               (SELECT message FROM chat_messages WHERE session_id = s.id ORDER BY created_at DESC LIMIT 1) as last_user_message,
-               (SELECT response FROM chat_messages WHERE session_id = s.id ORDER BY created_at DESC LIMIT 1) as last_ai_response
-        FROM chat_sessions s
-        WHERE s.user_id = ?
-        ORDER BY s.updated_at DESC
+    chat_writer.flush(user_id=user_id)
+    # Summaries are maintained on write, so this is one range read of the (user_id, updated_at) index
+    sessions = db.query_all('''
+        SELECT id, title, created_at, updated_at, message_count, last_message_preview
+        FROM chat_sessions
+        WHERE user_id = ?
+        ORDER BY updated_at DESC
     ''', (user_id,))
     
-    sessions = cursor.fetchall()
-    conn.close()
-    
-    result = []
-    for session in sessions:
-        last_message = session[5] if session[5] else None
-        last_response = session[6] if session[6] else None
-        
-        # Create a conversation preview
-        if last_message and last_response:
-            # Show both user message and AI response
-            preview = f"You: {last_message[:40]}{'...' if len(last_message) > 40 else ''}\nAI: {last_response[:40]}{'...' if len(last_response) > 40 else ''}"
-        elif last_message:
-            # Only user message exists
-            preview = f"You: {last_message[:60]}{'...' if len(last_message) > 60 else ''}"
-        else:
-            preview = 'No messages yet'
-            
-        result.append({
-            'id': session[0],
-            'title': session[1],
-            'created_at': session[2],
-            'updated_at': session[3],
-            'message_count': session[4],
-            'last_message': preview
-        })
-    
-    return result
+    return [session_summary(row) for row in sessions]
+
+def session_summary(row):
+    """Convert a chat_sessions summary row into the JSON shape used by the sidebar"""
+    return {
+        'id': row[0],
+        'title': row[1],
+        'created_at': row[2],
+        'updated_at': row[3],
+        'message_count': row[4],
+        'last_message': row[5] or 'No messages yet'
+    }
 
 def update_session_title(session_id, title):
     """Update session title"""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
+    with db.transaction() as cursor:
+        cursor.execute('''
+            UPDATE chat_sessions 
+            SET title = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (title, session_id))
+
+def load_session_context(session_id, model=None):
+    """Return the saved Ollama context for a session if model (default OLLAMA_MODEL) built it"""
+    chat_writer.flush(session_id=session_id)
+    row = db.query_one('''
+        SELECT context FROM chat_session_contexts
+        WHERE session_id = ? AND model = ?
+    ''', (session_id, model or OLLAMA_MODEL))
+    
+    return unpack_context(row[0]) if row else None
+
+def context_reuse_stats(context, result):
+    """Estimate the prompt-eval time saved by reusing a session's context"""
+    reused_tokens = len(context) if context else 0
+    prompt_tokens = result.get('prompt_eval_count') or 0
+    prompt_eval_ms = (result.get('prompt_eval_duration') or 0) / 1e6
+    # Reused tokens would have been evaluated at the same per-token rate
+    saved_ms = reused_tokens * prompt_eval_ms / prompt_tokens if prompt_tokens else 0.0
+    
+    if reused_tokens:
+        print(f"♻️ Reused {reused_tokens} context tokens, evaluated {prompt_tokens} new tokens "
+              f"in {prompt_eval_ms:.1f} ms (~{saved_ms:.1f} ms saved)")
+    return {
+        'reused_tokens': reused_tokens,
+        'prompt_eval_tokens': prompt_tokens,
+        'prompt_eval_ms': round(prompt_eval_ms, 1),
+        'estimated_saved_ms': round(saved_ms, 1)
+    }
+
+def write_chat_turn(cursor, session_id, user_id, message, ai_response, context=None, model=None, stopped=False):
+    """Insert a chat turn and update its session using cursor's transaction
+    
+    model is the model that answered (default OLLAMA_MODEL); stopped marks a
+    partial reply the user stopped. Returns the session's updated sidebar summary.
+    """
+    model = model or OLLAMA_MODEL
+    # Title used if this turn turns out to be the first in the session (first 50 chars)
+    title = message[:50] + "..." if len(message) > 50 else message
+    preview = format_session_preview(message, ai_response)
     
     cursor.execute('''
-        UPDATE chat_sessions 
-        SET title = ?, updated_at = CURRENT_TIMESTAMP
+        INSERT INTO chat_messages (session_id, user_id, message, response, model, stopped)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (session_id, user_id, message, ai_response, model, int(stopped)))
+    
+    # Maintain the session summary and auto-title new sessions in the same statement
+    cursor.execute('''
+        UPDATE chat_sessions
+        SET updated_at = CURRENT_TIMESTAMP,
+            last_activity = CURRENT_TIMESTAMP,
+            message_count = message_count + 1,
+            last_message_preview = ?,
+            title = CASE WHEN message_count = 0 THEN ? ELSE title END
         WHERE id = ?
-    ''', (title, session_id))
+    ''', (preview, title, session_id))
     
-    conn.commit()
-    conn.close()
-
-def update_session_timestamp(session_id):
-    """Update session's last activity timestamp"""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
+    if context:
+        cursor.execute('''
+            INSERT OR REPLACE INTO chat_session_contexts (session_id, model, context, updated_at)
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+        ''', (session_id, model, pack_context(context)))
+    else:
+        # Another model's saved context doesn't include this turn, so it can't be continued
+        cursor.execute('''
+            DELETE FROM chat_session_contexts WHERE session_id = ? AND model != ?
+        ''', (session_id, model))
     
     cursor.execute('''
-        UPDATE chat_sessions 
-        SET updated_at = CURRENT_TIMESTAMP
+        SELECT id, title, created_at, updated_at, message_count, last_message_preview
+        FROM chat_sessions
         WHERE id = ?
     ''', (session_id,))
+    return session_summary(cursor.fetchone())
+
+def save_chat_message(session_id, user_id, message, ai_response, context=None, model=None, stopped=False):
+    """Save a completed chat turn and update its session in one transaction
     
-    conn.commit()
-    conn.close()
+    context is the Ollama context returned for this turn, saved for the next one,
+    model the model that answered it and stopped whether the user stopped it.
+    Returns the session's updated sidebar summary, or None if saving failed.
+    In write-behind mode the turn is committed with others in a batch; with
+    "async" durability this returns None before the commit happens.
+    """
+    try:
+        if CHAT_WRITE_BEHIND_ENABLED:
+            ticket = chat_writer.submit(
+                lambda cursor: write_chat_turn(cursor, session_id, user_id, message, ai_response, context, model,
+                                               stopped),
+                session_id=session_id, user_id=user_id,
+                urgent=CHAT_WRITE_BEHIND_DURABILITY != 'async')
+            if CHAT_WRITE_BEHIND_DURABILITY == 'async':
+                return None
+            return ticket.wait(timeout=DATABASE_BUSY_TIMEOUT_MS / 1000 + 5)
+        
+        with db.transaction() as cursor:
+            return write_chat_turn(cursor, session_id, user_id, message, ai_response, context, model, stopped)
+    except Exception as e:
+        print(f"Error saving chat message: {e}")
+        return None
+
+def run_chat_turn(user_id, session_id, message, bypass_cache=False, cancel=None):
+    """Generate and save the reply to one chat message, returning the API payload
+    
+    If cancel (a threading.Event) is given, the reply is streamed so that
+    setting it stops the generation between tokens.
+    """
+    # A prompt built from history fits the conversation budget unless the message alone is longer
+    model = model_router.choose(message, max(estimate_tokens(message), conversation.token_budget))
+    # Continue from the session's saved context when there is one
+    context = load_session_context(session_id, model)
+    # Without one, send recent history and the rolling summary instead
+    prompt = message if context else conversation.build_prompt(session_id, message, user_id)
+    result = {}
+    if cancel is None:
+        ai_response = get_cached_ai_response(prompt, context=context, result=result,
+                                             bypass_cache=bypass_cache, user_id=user_id, model=model,
+                                             standalone=prompt == message)
+    else:
+        tokens = []
+        token_source = stream_reply(prompt, context, result, bypass_cache, user_id, model, prompt == message)
+        try:
+            for token in token_source:
+                if cancel.is_set():
+                    break
+                tokens.append(token)
+        finally:
+            token_source.close()
+        if cancel.is_set():
+            summary = save_partial_reply(session_id, user_id, message, tokens, result.get('model', model))
+            return {'reply': ''.join(tokens), 'session': summary, 'cancelled': True}
+        ai_response = ''.join(tokens) or 'No response from AI model.'
+    
+    # Save to database
+    model = result.get('model', model)
+    summary = save_chat_message(session_id, user_id, message, ai_response,
+                                context=result.get('context'), model=model)
+    
+    return {'reply': ai_response, 'session': summary, 'cached': bool(result.get('cached')),
+            'model': model, 'context_stats': context_reuse_stats(context, result)}
+
+def save_partial_reply(session_id, user_id, message, tokens, model=None):
+    """Keep what was generated before a reply was stopped (if enabled)
+    
+    The text is saved as generated, so later prompts, search and previews
+    don't see a marker; the stopped flag lets the client show one.
+    """
+    if not CHAT_SAVE_PARTIAL_REPLIES or not tokens:
+        return None
+    return save_chat_message(session_id, user_id, message, ''.join(tokens), model=model, stopped=True)
+
+# Worker threads for /api/chat/jobs, started on first use in each process
+chat_jobs = ChatJobQueue(db, run_chat_turn, workers=CHAT_JOB_WORKERS, max_pending=CHAT_JOB_MAX_PENDING)
 
 # Routes
 @app.route('/')
@@ -314,20 +765,34 @@ def login():
                 return jsonify({'error': 'Missing fields'}), 400
             return render_template('login.html', error='Missing fields')
         
-        conn = sqlite3.connect(DATABASE_NAME)
-        cursor = conn.cursor()
+        # Password checks are expensive, so limit attempts per account and per client
+        denied = rate_limit_exceeded('auth', user=username_or_email.lower())
+        if denied:
+            if request.is_json:
+                return too_many_requests(denied)
+            return render_template('login.html', error='Too many attempts. Please try again later.'), 429
         
         # Check if user exists by username or email
-        cursor.execute('''
+        user = db.query_one('''
             SELECT id, username, email, password_hash, phone 
             FROM users 
             WHERE username = ? OR email = ?
         ''', (username_or_email, username_or_email))
         
-        user = cursor.fetchone()
-        conn.close()
+        try:
+            valid = user is not None and password_hasher.verify(user[3], password)
+            # Upgrade hashes made with an older method or cost while we have the password
+            if valid and password_hasher.needs_rehash(user[3]):
+                new_hash = password_hasher.hash(password)
+                with db.transaction() as cursor:
+                    cursor.execute('UPDATE users SET password_hash = ? WHERE id = ?', (new_hash, user[0]))
+                print(f"🔐 Upgraded password hash for user {user[0]} to {PASSWORD_HASH_METHOD}")
+        except PasswordHasherBusy:
+            if request.is_json:
+                return jsonify({'error': 'Server busy, please try again'}), 503, {'Retry-After': '5'}
+            return render_template('login.html', error='Server busy, please try again'), 503
         
-        if user and check_password_hash(user[3], password):
+        if valid:
             session.permanent = True
             session['user_id'] = user[0]
             session['username'] = user[1]
@@ -365,21 +830,28 @@ def signup():
                 return jsonify({'error': 'Missing fields'}), 400
             return render_template('signup.html', error='Missing fields')
         
+        denied = rate_limit_exceeded('auth')
+        if denied:
+            if request.is_json:
+                return too_many_requests(denied)
+            return render_template('signup.html', error='Too many attempts. Please try again later.'), 429
+        
         # Hash password
-        password_hash = generate_password_hash(password)
+        try:
+            password_hash = password_hasher.hash(password)
+        except PasswordHasherBusy:
+            if request.is_json:
+                return jsonify({'error': 'Server busy, please try again'}), 503, {'Retry-After': '5'}
+            return render_template('signup.html', error='Server busy, please try again'), 503
         
         try:
-            conn = sqlite3.connect(DATABASE_NAME)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT INTO users (username, email, password_hash, phone)
-                VALUES (?, ?, ?, ?)
-            ''', (username, email, password_hash, phone))
-            
-            user_id = cursor.lastrowid
-            conn.commit()
-            conn.close()
+            with db.transaction() as cursor:
+                cursor.execute('''
+                    INSERT INTO users (username, email, password_hash, phone)
+                    VALUES (?, ?, ?, ?)
+                ''', (username, email, password_hash, phone))
+                
+                user_id = cursor.lastrowid
             
             if request.is_json:
                 return jsonify({'message': 'User created', 'userId': user_id}), 201
@@ -412,70 +884,244 @@ def chat(session_id=None):
                          username=session.get('username'),
                          email=session.get('email'),
                          phone=session.get('phone', ''),
-                         current_session_id=session_id)
+                         current_session_id=session_id,
+                         health_events=HEALTH_EVENTS_MAX_SUBSCRIBERS > 0)
 
-@app.route('/api/chat', methods=['POST'])
-def api_chat():
-    """API endpoint for chat messages"""
+def parse_chat_request():
+    """Validate a chat message request and check a generation can start now
+    
+    Returns ((user_id, session_id, message, bypass_cache), None) for a request
+    to go ahead, or (None, error response) for the route to return.
+    """
     if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
+        return None, (jsonify({'error': 'Not authenticated'}), 401)
+    user_id = session['user_id']
+    
+    denied = rate_limit_exceeded('chat', user=user_id)
+    if denied:
+        return None, too_many_requests(denied)
     
     data = request.get_json()
     message = data.get('message')
     session_id = data.get('session_id')
     
     if not message:
-        return jsonify({'error': 'No message provided'}), 400
+        return None, (jsonify({'error': 'No message provided'}), 400)
     
     if not session_id:
-        return jsonify({'error': 'No session ID provided'}), 400
+        return None, (jsonify({'error': 'No session ID provided'}), 400)
     
-    # Verify session ownership
-    if not verify_session_ownership(session_id, session['user_id']):
-        return jsonify({'error': 'Invalid session'}), 403
+    if not verify_session_ownership(session_id, user_id):
+        return None, (jsonify({'error': 'Invalid session'}), 403)
     
-    # Get AI response
-    ai_response = get_ai_response(message)
+    # Don't hold a worker thread on a call that is known to fail
+    if ollama_breaker.is_open():
+        return None, ollama_unavailable()
+    try:
+        generation_scheduler.check_admission()
+    except QueueFullError as e:
+        return None, generation_queue_full(e)
+    
+    # Skip the response cache with {"cache": false} or Cache-Control: no-cache
+    bypass_cache = data.get('cache') is False or 'no-cache' in request.headers.get('Cache-Control', '')
+    return (user_id, session_id, message, bypass_cache), None
+
+@app.route('/api/chat', methods=['POST'])
+def api_chat():
+    """API endpoint for chat messages"""
+    chat_request, error = parse_chat_request()
+    if error:
+        return error
+    user_id, session_id, message, bypass_cache = chat_request
     
-    # Save to database
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO chat_messages (session_id, user_id, message, response)
-            VALUES (?, ?, ?, ?)
-        ''', (session_id, session['user_id'], message, ai_response))
-        
-        # Update session timestamp
-        update_session_timestamp(session_id)
-        
-        # Auto-generate title for new sessions
-        cursor.execute('SELECT COUNT(*) FROM chat_messages WHERE session_id = ?', (session_id,))
-        message_count = cursor.fetchone()[0]
-        
-        if message_count == 1:  # First message in session
-            # Generate title from first message (first 50 chars)
-            title = message[:50] + "..." if len(message) > 50 else message
-            update_session_title(session_id, title)
+        return jsonify(run_chat_turn(user_id, session_id, message, bypass_cache=bypass_cache))
+    except QueueFullError as e:
+        return generation_queue_full(e)
+    except CircuitOpenError as e:
+        return ollama_unavailable(e)
+
+@app.route('/api/chat/jobs', methods=['POST'])
+def api_chat_job_submit():
+    """Queue a chat message for a background worker and return its job id"""
+    chat_request, error = parse_chat_request()
+    if error:
+        return error
+    user_id, session_id, message, bypass_cache = chat_request
+    
+    try:
+        job_id = chat_jobs.submit(user_id, session_id, message, bypass_cache=bypass_cache)
+    except JobQueueFullError:
+        return jsonify({'error': 'AI service is busy. Please try again shortly.'}), 429, {'Retry-After': '10'}
+    
+    return jsonify({'job_id': job_id, 'status': 'queued'}), 202, {'Location': url_for('api_chat_job', job_id=job_id)}
+
+@app.route('/api/chat/jobs/<job_id>', methods=['DELETE'])
+def api_chat_job_cancel(job_id):
+    """Cancel a queued or running job"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    job = chat_jobs.cancel(job_id, session['user_id'])
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/api/chat/jobs/<job_id>')
+def api_chat_job(job_id):
+    """Job status and result; ?wait=N long-polls up to N seconds for it to finish"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    wait = min(request.args.get('wait', 0, type=float), CHAT_JOB_MAX_WAIT_SECONDS)
+    if wait > 0:
+        job = chat_jobs.wait(job_id, session['user_id'], timeout=wait)
+    else:
+        job = chat_jobs.get(job_id, session['user_id'])
+    
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/api/chat/stream', methods=['POST'])
+def api_chat_stream():
+    """Streaming API endpoint for chat messages (newline-delimited JSON)"""
+    chat_request, error = parse_chat_request()
+    if error:
+        return error
+    user_id, session_id, message, bypass_cache = chat_request
+    
+    def generate():
+        model = model_router.choose(message, max(estimate_tokens(message), conversation.token_budget))
+        context = load_session_context(session_id, model)
+        prompt = message if context else conversation.build_prompt(session_id, message, user_id)
+        result = {}
+        tokens = []
+        token_source = stream_reply(prompt, context, result, bypass_cache, user_id, model, prompt == message)
+        try:
+            for token in token_source:
+                tokens.append(token)
+                yield json.dumps({'token': token}) + "\n"
+        except GeneratorExit:
+            # The client pressed stop, closed the tab or navigated away
+            token_source.close()
+            print(f"⏹️ Client disconnected after {len(tokens)} tokens, generation cancelled")
+            save_partial_reply(session_id, user_id, message, tokens, result.get('model', model))
+            raise
         
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        print(f"Error saving chat message: {e}")
+        # Persist the complete reply once the stream has ended
+        ai_response = ''.join(tokens) or 'No response from AI model.'
+        summary = save_chat_message(session_id, user_id, message, ai_response,
+                                    context=result.get('context'), model=result.get('model', model))
+        yield json.dumps({'done': True, 'reply': ai_response, 'session': summary,
+                          'cached': bool(result.get('cached')), 'model': result.get('model', model),
+                          'context_stats': context_reuse_stats(context, result)}) + "\n"
+    
+    # Run up to the first line here, so that a full queue or open circuit met while
+    # waiting for a slot is still a 429/503 rather than an error inside a 200 stream
+    lines = generate()
+    try:
+        first_line = next(lines)
+    except QueueFullError as e:
+        return generation_queue_full(e)
+    except CircuitOpenError as e:
+        return ollama_unavailable(e)
     
-    return jsonify({'reply': ai_response})
+    def resume():
+        yield first_line
+        yield from lines
+    
+    return Response(stream_with_context(resume()),
+                    mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/api/health/ollama')
 def health_ollama():
-    """Health check for Ollama service"""
-    health_status = check_ollama_health()
+    """Health check for Ollama service (served from the background monitor)"""
+    health_status = health_monitor.snapshot()
+    health_status['circuit'] = ollama_breaker.snapshot()
+    health_status['warmup'] = model_warmer.stats()
+    health_status['routing'] = model_router.stats()
     status_code = 200 if health_status['status'] == 'healthy' else 503
     return jsonify(health_status), status_code
 
+@app.route('/api/health/ollama/backends')
+def health_ollama_backends():
+    """Live routing state of each Ollama server in this process"""
+    return jsonify({'backends': ollama.stats()})
+
+@app.route('/api/health/ollama/events')
+def health_ollama_events():
+    """Server-Sent Events stream of Ollama status changes (opt-in)"""
+    # Each open stream holds a WSGI thread for minutes, so streams are off unless configured
+    if not HEALTH_EVENTS_MAX_SUBSCRIBERS:
+        return jsonify({'error': 'Status streaming is disabled, poll /api/health/ollama instead'}), 404
+    if not health_event_slots.acquire(blocking=False):
+        return jsonify({'error': 'Too many status subscribers, poll /api/health/ollama instead'}), 503, {'Retry-After': '30'}
+    
+    def events():
+        deadline = time.monotonic() + HEALTH_EVENTS_MAX_SECONDS
+        status = health_monitor.snapshot()
+        yield f"data: {json.dumps(status)}\n\n"
+        while time.monotonic() < deadline:
+            timeout = min(15, max(0, deadline - time.monotonic()))
+            latest = health_monitor.wait_for_change(status['version'], timeout=timeout)
+            if latest['version'] == status['version']:
+                # Comment line keeps proxies from closing an idle stream
+                yield ": keepalive\n\n"
+                continue
+            status = latest
+            yield f"data: {json.dumps(status)}\n\n"
+    
+    response = Response(events(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(health_event_slots.release)
+    return response
+
+@app.route('/api/health/db')
+def health_db():
+    """Write transaction latency for the SQLite database"""
+    stats = db.transaction_stats()
+    stats['write_behind'] = dict(chat_writer.stats(), enabled=CHAT_WRITE_BEHIND_ENABLED)
+    return jsonify(stats)
+
+@app.route('/api/health/queue')
+def health_queue():
+    """Generation queue depth and wait times for this process"""
+    stats = generation_scheduler.stats()
+    stats['jobs'] = chat_jobs.stats()
+    return jsonify(stats)
+
+@app.route('/api/health/auth')
+def health_auth():
+    """Password hash latency for tuning PASSWORD_HASH_METHOD against the login SLO"""
+    return jsonify(password_hasher.stats())
+
+@app.route('/api/health/cache')
+def health_cache():
+    """Response cache and request coalescing counters for this process"""
+    stats = response_cache.stats()
+    stats['semantic'] = dict(semantic_cache.stats(), enabled=SEMANTIC_CACHE_ENABLED)
+    stats['coalescing'] = generation_flights.stats()
+    return jsonify(stats)
+
+# Current load, read when /metrics is scraped
+metrics.Gauge('chatapp_generations_active', 'Generations running against Ollama',
+              lambda: generation_scheduler.stats()['active'])
+metrics.Gauge('chatapp_generations_queued', 'Generations waiting for a slot', generation_scheduler.queue_depth)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics for this process"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/api/chat-history/<int:session_id>')
 def chat_history(session_id):
-    """Get chat history for a specific session"""
+    """Get one page of chat history for a specific session
+    
+    Returns the newest page by default. Pass the returned next_cursor as
+    ?before= to fetch the page of older messages preceding it.
+    """
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
@@ -483,28 +1129,82 @@ def chat_history(session_id):
     if not verify_session_ownership(session_id, session['user_id']):
         return jsonify({'error': 'Invalid session'}), 403
     
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
+    limit = min(request.args.get('limit', CHAT_HISTORY_PAGE_SIZE, type=int), CHAT_HISTORY_MAX_PAGE_SIZE)
+    if limit < 1:
+        return jsonify({'error': 'Invalid page size'}), 400
     
-    cursor.execute('''
-        SELECT message, response, created_at 
-        FROM chat_messages 
-        WHERE session_id = ? 
-        ORDER BY created_at ASC
-    ''', (session_id,))
+    chat_writer.flush(session_id=session_id)
+    
+    before = request.args.get('before')
+    if before:
+        # Cursor is "<created_at>|<id>" of the oldest message already loaded
+        try:
+            before_created_at, before_id = before.rsplit('|', 1)
+            before_id = int(before_id)
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        
+        messages = db.query_all('''
+            SELECT id, message, response, created_at, model, stopped
+            FROM chat_messages 
+            WHERE session_id = ? AND (created_at, id) < (?, ?)
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        ''', (session_id, before_created_at, before_id, limit + 1))
+    else:
+        messages = db.query_all('''
+            SELECT id, message, response, created_at, model, stopped
+            FROM chat_messages 
+            WHERE session_id = ? 
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        ''', (session_id, limit + 1))
     
-    messages = cursor.fetchall()
-    conn.close()
+    # One extra row tells us whether an older page exists
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    next_cursor = f"{messages[-1][3]}|{messages[-1][0]}" if has_more else None
     
     chat_history = []
-    for msg in messages:
+    for msg in reversed(messages):
         chat_history.append({
-            'user_message': msg[0],
-            'ai_response': msg[1],
-            'timestamp': msg[2]
+            'user_message': msg[1],
+            'ai_response': msg[2],
+            'timestamp': msg[3],
+            'model': msg[4],
+            'stopped': bool(msg[5])
         })
     
-    return jsonify({'history': chat_history})
+    return jsonify({'history': chat_history, 'has_more': has_more, 'next_cursor': next_cursor})
+
+@app.route('/api/search')
+def search():
+    """Full-text search over the user's messages and replies, best matches first
+    
+    ?q= takes words (all must match) and "quoted phrases". Matches are ranked
+    SEARCH_MAX_RESULTS at a time, newest first; page with ?limit= and the
+    returned next_offset as ?offset= and next_before as ?before=. Snippets
+    are HTML-escaped and mark matches with <mark>.
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Search query cannot be empty'}), 400
+    limit = min(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), SEARCH_MAX_PAGE_SIZE)
+    offset = request.args.get('offset', 0, type=int)
+    before = request.args.get('before', type=int)
+    if limit < 1 or offset < 0:
+        return jsonify({'error': 'Invalid page'}), 400
+    
+    user_id = session['user_id']
+    chat_writer.flush(user_id=user_id)
+    hits, next_page = search_messages(db, user_id, query, limit=limit, offset=offset,
+                                      max_candidates=SEARCH_MAX_RESULTS, before=before)
+    return jsonify({'results': hits, 'has_more': next_page is not None,
+                    'next_offset': next_page['offset'] if next_page else None,
+                    'next_before': next_page['before'] if next_page else None})
 
 @app.route('/api/clear-chat-history/<int:session_id>', methods=['POST'])
 def clear_chat_history(session_id):
@@ -516,20 +1216,29 @@ def clear_chat_history(session_id):
     if not verify_session_ownership(session_id, session['user_id']):
         return jsonify({'error': 'Invalid session'}), 403
     
+    # Queued turns would otherwise land after the delete
+    chat_writer.flush(session_id=session_id)
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            DELETE FROM chat_messages 
-            WHERE session_id = ?
-        ''', (session_id,))
-        
-        # Reset session title
-        update_session_title(session_id, 'New Chat')
-        
-        conn.commit()
-        conn.close()
+        with db.transaction() as cursor:
+            cursor.execute('''
+                DELETE FROM chat_messages 
+                WHERE session_id = ?
+            ''', (session_id,))
+            
+            # The model's memory of the cleared turns goes with them
+            cursor.execute('DELETE FROM chat_session_contexts WHERE session_id = ?', (session_id,))
+            cursor.execute('DELETE FROM chat_session_summaries WHERE session_id = ?', (session_id,))
+            
+            # Reset session title and summary
+            cursor.execute('''
+                UPDATE chat_sessions
+                SET title = 'New Chat',
+                    updated_at = CURRENT_TIMESTAMP,
+                    message_count = 0,
+                    last_message_preview = NULL,
+                    last_activity = NULL
+                WHERE id = ?
+            ''', (session_id,))
         
         return jsonify({'success': True, 'message': 'Chat history cleared'})
     except Exception as e:
@@ -567,18 +1276,17 @@ def delete_session(session_id):
     if not verify_session_ownership(session_id, session['user_id']):
         return jsonify({'error': 'Invalid session'}), 403
     
+    # Queued turns would otherwise land after the delete
+    chat_writer.flush(session_id=session_id)
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        cursor = conn.cursor()
-        
-        # Delete messages first (foreign key constraint)
-        cursor.execute('DELETE FROM chat_messages WHERE session_id = ?', (session_id,))
-        
-        # Delete session
-        cursor.execute('DELETE FROM chat_sessions WHERE id = ?', (session_id,))
-        
-        conn.commit()
-        conn.close()
+        with db.transaction() as cursor:
+            # Delete messages first (foreign key constraint)
+            cursor.execute('DELETE FROM chat_messages WHERE session_id = ?', (session_id,))
+            
+            # Delete session and its saved model context
+            cursor.execute('DELETE FROM chat_session_contexts WHERE session_id = ?', (session_id,))
+            cursor.execute('DELETE FROM chat_session_summaries WHERE session_id = ?', (session_id,))
+            cursor.execute('DELETE FROM chat_sessions WHERE id = ?', (session_id,))
         
         return jsonify({'success': True})
     except Exception as e:
@@ -625,9 +1333,15 @@ if __name__ == '__main__':
     # Initialize database
     init_db()
     
+    # Load the model before the first request needs it
+    model_warmer.start()
+    
+    # Chat job workers; their heartbeat also fails jobs left behind by a previous run
+    chat_jobs.start()
+    
     print("🚀 Starting AI Chat App...")
     print(f"📡 Server: http://{FLASK_HOST}:{FLASK_PORT}")
-    print(f"🤖 Ollama URL: {OLLAMA_URL}")
+    print(f"🤖 Ollama URL: {', '.join(OLLAMA_URLS)}")
     print(f"🧠 AI Model: {OLLAMA_MODEL}")
     print("=" * 50)
     
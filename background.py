@@ -0,0 +1,56 @@
+"""
+Per-process background threads
+mod_wsgi and other pre-forking servers may fork after app.py is imported, and
+threads don't survive a fork: a service started in the parent has none in the
+child. BackgroundThreads remembers which process started its threads and
+starts them again the first time they are needed in another process (or if
+one of them has died), so every worker process runs its own.
+"""
+
+import os
+import threading
+
+
+class BackgroundThreads:
+    """Daemon threads that are running at most once per process
+
+    targets are (thread name, function) pairs. on_start, if given, is called
+    as on_start(forked) just before the threads start, with forked True when
+    they last ran in another process, so state copied from the parent (such
+    as unsynced counts) can be reset.
+    """
+
+    def __init__(self, targets, on_start=None):
+        self.targets = list(targets)
+        self.on_start = on_start
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _running(self):
+        return self._pid == os.getpid() and all(thread.is_alive() for thread in self._threads)
+
+    def start(self):
+        """Start the threads in this process unless they are running; True if they were started"""
+        # Checked without the lock first, since callers may start() on every request
+        if self._running():
+            return False
+        with self._lock:
+            if self._running():
+                return False
+            forked = self._pid is not None and self._pid != os.getpid()
+            self._pid = os.getpid()
+            if self.on_start is not None:
+                self.on_start(forked)
+            self._threads = [threading.Thread(target=target, name=name, daemon=True)
+                             for name, target in self.targets]
+            for thread in self._threads:
+                thread.start()
+            return True
+
+    def running(self):
+        """This process's threads that are still alive"""
+        with self._lock:
+            if self._pid != os.getpid():
+                return []
+            return [thread for thread in self._threads if thread.is_alive()]
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+Performance benchmarks for AI Chat App
+Run: python benchmark.py <benchmark> [options]   (see --help for the list)
+"""
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from db import Database
+from migrations import migrate, get_schema_version, add_hot_path_indexes
+from rate_limit import RateLimiter
+from search import search_messages
+from write_behind import WriteBehindBuffer
+
+# Messages per chat history page (CHAT_HISTORY_PAGE_SIZE)
+HISTORY_PAGE_SIZE = 50
+# Indexes created by the hot-path index migration
+HOT_PATH_INDEXES = ('idx_chat_messages_session_created', 'idx_chat_sessions_user_updated',
+                    'idx_chat_sessions_user_created')
+
+# Hot-path queries issued by app.py, with the parameters used to exercise them
+HOT_QUERIES = [
+    ('chat history page', '''
+        SELECT id, message, response, created_at, model
+        FROM chat_messages
+        WHERE session_id = ?
+        ORDER BY created_at DESC, id DESC
+        LIMIT ?
+    ''', lambda ctx: (ctx['session_id'], HISTORY_PAGE_SIZE + 1)),
+    ('chat history older page', '''
+        SELECT id, message, response, created_at, model
+        FROM chat_messages
+        WHERE session_id = ? AND (created_at, id) < (?, ?)
+        ORDER BY created_at DESC, id DESC
+        LIMIT ?
+    ''', lambda ctx: (ctx['session_id'], *ctx['before'], HISTORY_PAGE_SIZE + 1)),
+    ('session list', '''
+        SELECT id, title, created_at, updated_at, message_count, last_message_preview
+        FROM chat_sessions
+        WHERE user_id = ?
+        ORDER BY updated_at DESC
+    ''', lambda ctx: (ctx['user_id'],)),
+    ('session ownership', '''
+        SELECT id FROM chat_sessions
+        WHERE id = ? AND user_id = ?
+    ''', lambda ctx: (ctx['session_id'], ctx['user_id'])),
+    ('default session', '''
+        SELECT id FROM chat_sessions
+        WHERE user_id = ?
+        ORDER BY created_at DESC
+        LIMIT 1
+    ''', lambda ctx: (ctx['user_id'],)),
+    ('login lookup', '''
+        SELECT id, username, email, password_hash, phone
+        FROM users
+        WHERE username = ? OR email = ?
+    ''', lambda ctx: (ctx['username'], ctx['username'])),
+]
+
+
+def seed_database(db, messages, users, sessions_per_user):
+    """Fill an empty database with synthetic users, sessions and messages"""
+    print(f"🌱 Seeding {messages:,} messages for {users:,} users...")
+    started = time.perf_counter()
+    rng = random.Random(42)
+    base_time = 1700000000
+
+    with db.transaction() as cursor:
+        cursor.executemany(
+            'INSERT INTO users (id, username, email, password_hash, phone) VALUES (?, ?, ?, ?, ?)',
+            ((u, f'user{u}', f'user{u}@example.com', 'x', '') for u in range(1, users + 1)))
+
+        session_count = users * sessions_per_user
+        cursor.executemany(
+            'INSERT INTO chat_sessions (id, user_id, title, created_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+            ((s, (s - 1) % users + 1, f'Chat {s}',
+              time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(base_time + s)),
+              time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(base_time + s)))
+             for s in range(1, session_count + 1)))
+
+        def rows():
+            for m in range(1, messages + 1):
+                session_id = rng.randint(1, session_count)
+                yield (session_id, (session_id - 1) % users + 1,
+                       f'Question number {m} about topic {m % 97}',
+                       f'Answer number {m} with some generated text for topic {m % 97}.',
+                       time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(base_time + m)))
+
+        cursor.executemany('''
+            INSERT INTO chat_messages (session_id, user_id, message, response, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', rows())
+
+    print(f"✅ Seeded in {time.perf_counter() - started:.1f}s")
+    return {'user_id': 1, 'session_id': 1, 'username': f'user{users // 2}'}
+
+
+def report_queries(db, ctx, repeat):
+    """Print the query plan and mean latency of each hot-path query"""
+    for name, sql, params in HOT_QUERIES:
+        args = params(ctx)
+        plan = db.query_all('EXPLAIN QUERY PLAN ' + sql, args)
+        started = time.perf_counter()
+        for _ in range(repeat):
+            db.query_all(sql, args)
+        elapsed_ms = (time.perf_counter() - started) * 1000 / repeat
+        print(f"\n  {name}: {elapsed_ms:.3f} ms")
+        for row in plan:
+            print(f"    {row[-1]}")
+
+
+def bench_indexes(args):
+    """Compare hot-path query plans with and without the hot-path indexes"""
+    workdir = tempfile.mkdtemp(prefix='chatapp-bench-')
+    try:
+        db = Database(os.path.join(workdir, 'bench.db'))
+        migrate(db, target=1)
+        ctx = seed_database(db, args.messages, args.users, args.sessions_per_user)
+
+        # The current queries read columns added by later migrations (e.g. the session summaries)
+        started = time.perf_counter()
+        migrate(db)
+        print(f"⏱️ Migration to schema version {get_schema_version(db)} took {time.perf_counter() - started:.1f}s")
+
+        # Keyset cursor of the oldest message on the newest history page
+        ctx['before'] = tuple(db.query_one('''
+            SELECT created_at, id FROM chat_messages WHERE session_id = ?
+            ORDER BY created_at DESC, id DESC LIMIT 1 OFFSET ?
+        ''', (ctx['session_id'], HISTORY_PAGE_SIZE - 1)) or ('9999-12-31', 0))
+
+        with db.transaction() as cursor:
+            for index in HOT_PATH_INDEXES:
+                cursor.execute(f'DROP INDEX {index}')
+            cursor.execute('ANALYZE')
+        print("\n📊 Without the hot-path indexes")
+        report_queries(db, ctx, args.repeat)
+
+        started = time.perf_counter()
+        with db.transaction() as cursor:
+            add_hot_path_indexes(cursor)
+        print(f"\n⏱️ Creating the indexes took {time.perf_counter() - started:.1f}s")
+
+        print("\n📊 With the hot-path indexes")
+        report_queries(db, ctx, args.repeat)
+        db.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def percentile_us(samples, pct):
+    """Percentile of a list of durations in seconds, as microseconds"""
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct))] * 1e6
+
+
+def bench_ratelimit(args):
+    """Measure the per-request cost of the token-bucket limiter and of its database sync"""
+    workdir = tempfile.mkdtemp(prefix='chatapp-bench-')
+    try:
+        limiter = RateLimiter(Database(os.path.join(workdir, 'ratelimit.db')), {
+            # Generous limits so the benchmark measures allowed requests, the common case
+            'chat': {'user': (10**9, 10**9), 'ip': (10**9, 10**9)},
+        })
+        limiter.check('chat', user=0, ip='127.0.0.1')
+
+        for threads in args.threads:
+            timings = [[] for _ in range(threads)]
+
+            def worker(index):
+                rng = random.Random(index)
+                for _ in range(args.requests // threads):
+                    user = rng.randrange(args.users)
+                    started = time.perf_counter()
+                    limiter.check('chat', user=user, ip=f'10.0.{user % 256}.{user // 256 % 256}')
+                    timings[index].append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+            for thread in pool:
+                thread.start()
+            for thread in pool:
+                thread.join()
+            elapsed = time.perf_counter() - started
+
+            samples = [t for per_thread in timings for t in per_thread]
+            print(f"📊 {threads} thread(s): {len(samples) / elapsed:,.0f} checks/s, "
+                  f"p50 {percentile_us(samples, 0.50):.1f} µs, "
+                  f"p99 {percentile_us(samples, 0.99):.1f} µs")
+
+            # The background thread does this once per sync interval, off the request path
+            started = time.perf_counter()
+            limiter.sync()
+            print(f"   sync of {args.users * 2:,} buckets: {(time.perf_counter() - started) * 1000:.1f} ms")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench_search(args):
+    """Measure /api/search query latency on a large chat history"""
+    workdir = tempfile.mkdtemp(prefix='chatapp-bench-')
+    try:
+        db = Database(os.path.join(workdir, 'bench.db'))
+        migrate(db, target=7)
+        seed_database(db, args.messages, args.users, args.sessions_per_user)
+
+        started = time.perf_counter()
+        migrate(db)
+        print(f"⏱️ Indexing existing history (migration 8) took {time.perf_counter() - started:.1f}s")
+
+        # From words in every message down to rare terms and phrases
+        queries = ['topic', 'answer generated text', 'generating', '"topic 42"', '4242', 'nothingmatches']
+        rng = random.Random(7)
+        for text in queries:
+            timings = []
+            for _ in range(args.repeat):
+                user_id = rng.randint(1, args.users)
+                started = time.perf_counter()
+                hits, _ = search_messages(db, user_id, text, limit=20)
+                timings.append(time.perf_counter() - started)
+            print(f"📊 {text!r}: p50 {percentile_us(timings, 0.50) / 1000:.2f} ms, "
+                  f"p99 {percentile_us(timings, 0.99) / 1000:.2f} ms, last page {len(hits)} hits")
+        db.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def write_turn(cursor, session_id, user_id, n):
+    """The statements app.py's save_chat_message runs for one chat turn"""
+    cursor.execute('''
+        INSERT INTO chat_messages (session_id, user_id, message, response)
+        VALUES (?, ?, ?, ?)
+    ''', (session_id, user_id, f'Question number {n}', f'Answer number {n} with some generated text.'))
+    cursor.execute('''
+        UPDATE chat_sessions
+        SET updated_at = CURRENT_TIMESTAMP,
+            last_activity = CURRENT_TIMESTAMP,
+            message_count = message_count + 1,
+            last_message_preview = ?
+        WHERE id = ?
+    ''', (f'Question number {n}', session_id))
+
+
+def bench_writes(args):
+    """Compare chat turn inserts/sec with per-request commits and write-behind group commits"""
+    modes = [('per-request commit', None), ('write-behind (group)', 'group'), ('write-behind (async)', 'async')]
+    for name, durability in modes:
+        workdir = tempfile.mkdtemp(prefix='chatapp-bench-')
+        try:
+            db = Database(os.path.join(workdir, 'bench.db'))
+            migrate(db)
+            seed_database(db, 0, args.users, 1)
+            writer = WriteBehindBuffer(db, max_batch=args.max_batch, max_delay=args.max_delay_ms / 1000,
+                                       synchronous=args.synchronous)
+            timings = [[] for _ in range(args.threads)]
+
+            def worker(index):
+                if args.synchronous:
+                    db.execute(f'PRAGMA synchronous={args.synchronous}')
+                for n in range(args.turns // args.threads):
+                    session_id = (index * 7919 + n) % args.users + 1
+                    started = time.perf_counter()
+                    if durability is None:
+                        with db.transaction() as cursor:
+                            write_turn(cursor, session_id, session_id, n)
+                    else:
+                        ticket = writer.submit(lambda cursor, s=session_id, n=n: write_turn(cursor, s, s, n),
+                                               session_id=session_id, user_id=session_id,
+                                               urgent=durability == 'group')
+                        if durability == 'group':
+                            ticket.wait()
+                    timings[index].append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            pool = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+            for thread in pool:
+                thread.start()
+            for thread in pool:
+                thread.join()
+            # Async submissions only count once they are committed
+            writer.close()
+            elapsed = time.perf_counter() - started
+
+            samples = [t for per_thread in timings for t in per_thread]
+            stored = db.query_one('SELECT COUNT(*) FROM chat_messages')[0]
+            batch_info = f", {writer.stats()['batch_size_avg']} turns/commit" if durability else ''
+            print(f"📊 {name}: {stored / elapsed:,.0f} inserts/s, "
+                  f"p50 {percentile_us(samples, 0.50):.0f} µs, "
+                  f"p99 {percentile_us(samples, 0.99):.0f} µs{batch_info}")
+            db.close()
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    benchmarks = parser.add_subparsers(dest='benchmark', required=True)
+
+    indexes = benchmarks.add_parser('indexes', help=bench_indexes.__doc__)
+    indexes.add_argument('--messages', type=int, default=1_000_000)
+    indexes.add_argument('--users', type=int, default=1_000)
+    indexes.add_argument('--sessions-per-user', type=int, default=20)
+    indexes.add_argument('--repeat', type=int, default=20)
+    indexes.set_defaults(run=bench_indexes)
+
+    ratelimit = benchmarks.add_parser('ratelimit', help=bench_ratelimit.__doc__)
+    ratelimit.add_argument('--requests', type=int, default=20_000)
+    ratelimit.add_argument('--users', type=int, default=1_000)
+    ratelimit.add_argument('--threads', type=int, nargs='+', default=[1, 5])
+    ratelimit.set_defaults(run=bench_ratelimit)
+
+    search = benchmarks.add_parser('search', help=bench_search.__doc__)
+    search.add_argument('--messages', type=int, default=2_000_000)
+    search.add_argument('--users', type=int, default=1_000)
+    search.add_argument('--sessions-per-user', type=int, default=20)
+    search.add_argument('--repeat', type=int, default=50)
+    search.set_defaults(run=bench_search)
+
+    writes = benchmarks.add_parser('writes', help=bench_writes.__doc__)
+    writes.add_argument('--turns', type=int, default=20_000)
+    writes.add_argument('--users', type=int, default=100)
+    writes.add_argument('--threads', type=int, default=16)
+    writes.add_argument('--max-batch', type=int, default=64)
+    writes.add_argument('--max-delay-ms', type=float, default=20)
+    writes.add_argument('--synchronous', choices=['NORMAL', 'FULL'], default=None)
+    writes.set_defaults(run=bench_writes)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
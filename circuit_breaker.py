@@ -0,0 +1,98 @@
+"""
+Circuit breaker for Ollama calls
+After repeated failures the circuit opens and calls fail immediately instead
+of tying up a worker thread until they time out. Once the reset timeout has
+passed a single trial call is let through (half-open); its outcome decides
+whether the circuit closes again or stays open for another period.
+"""
+
+import math
+import threading
+import time
+
+import requests
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of calling Ollama while the circuit is open"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Ollama circuit is open, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker shared by all threads in a process"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_started_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return True if a call may go ahead, claiming the trial slot when half-open"""
+        now = time.monotonic()
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN and now - self._opened_at < self.reset_timeout:
+                return False
+            # A trial that never reported back (e.g. an abandoned stream) doesn't block forever
+            if self._trial_started_at is not None and now - self._trial_started_at < self.reset_timeout:
+                return False
+            if self._state == OPEN:
+                print("🟡 Ollama circuit half-open, sending a trial request")
+            self._state = HALF_OPEN
+            self._trial_started_at = now
+            return True
+
+    def is_open(self):
+        """True when calls would currently be rejected (doesn't claim the trial slot)"""
+        now = time.monotonic()
+        with self._lock:
+            if self._state == OPEN:
+                return now - self._opened_at < self.reset_timeout
+            if self._state == HALF_OPEN:
+                return self._trial_started_at is not None and now - self._trial_started_at < self.reset_timeout
+            return False
+
+    def retry_after(self):
+        """Whole seconds until the next trial call may be attempted"""
+        with self._lock:
+            start = self._trial_started_at if self._state == HALF_OPEN else self._opened_at
+            remaining = start + self.reset_timeout - time.monotonic()
+        return max(1, math.ceil(remaining))
+
+    def record_success(self):
+        with self._lock:
+            if self._state != CLOSED:
+                print("🟢 Ollama circuit closed")
+            self._state = CLOSED
+            self._failures = 0
+            self._trial_started_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or (self._state == CLOSED and self._failures >= self.failure_threshold):
+                print(f"🔴 Ollama circuit opened after {self._failures} consecutive failures")
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self._trial_started_at = None
+
+    def snapshot(self):
+        """Current state for health reporting"""
+        open_now = self.is_open()
+        with self._lock:
+            state = {'state': self._state, 'consecutive_failures': self._failures}
+        if open_now:
+            state['retry_after'] = self.retry_after()
+        return state
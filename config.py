@@ -8,11 +8,101 @@ SECRET_KEY = "your-secret-key-here-change-in-production"
 
 # Database Configuration
 DATABASE_NAME = "chatapp.db"
+DATABASE_BUSY_TIMEOUT_MS = 5000  # How long a writer waits for the lock before "database is locked"
 
 # Ollama Configuration
 OLLAMA_URL = "http://localhost:11434"
 OLLAMA_MODEL = "llama3.2:1b-instruct-q4_K_M"
-OLLAMA_TIMEOUT = 30
+OLLAMA_TIMEOUT = 30  # Seconds to wait for the first byte of a reply
+OLLAMA_CONNECT_TIMEOUT = 3  # Seconds to establish a TCP connection
+OLLAMA_TOTAL_TIMEOUT = 120  # Upper bound for a whole (streamed) generation
+OLLAMA_POOL_SIZE = 10  # Keep-alive connections per process
+OLLAMA_MAX_RETRIES = 2  # Retries for idempotent calls such as /api/tags
+OLLAMA_URLS = [OLLAMA_URL]  # Add more Ollama servers to spread generations across them
+OLLAMA_BACKEND_MAX_FAILURES = 3  # Consecutive failures before a server is taken out of rotation
+OLLAMA_BACKEND_EJECT_SECONDS = 30  # Time out of rotation unless a health probe succeeds sooner
+OLLAMA_BREAKER_FAILURE_THRESHOLD = 5  # Consecutive failed calls before chat fails fast with 503
+OLLAMA_BREAKER_RESET_SECONDS = 30  # How long the circuit stays open before a trial request
+OLLAMA_WARM_MODELS = []  # Extra models to keep loaded at all times (e.g. an embedding model)
+OLLAMA_KEEP_ALIVE_MIN_SECONDS = 300  # keep_alive sent with requests adapts to traffic between these bounds
+OLLAMA_KEEP_ALIVE_MAX_SECONDS = 3600  # Also how long the chat model is kept warm after the last request
+OLLAMA_WARM_CHECK_INTERVAL = 60  # Seconds between checks that the models are still loaded
+
+# Model Routing Configuration
+# Larger models for long or hard messages, smallest first, as (model, minimum complexity 0-1);
+# OLLAMA_MODEL answers everything else and is the fallback. Empty disables routing.
+OLLAMA_ROUTED_MODELS = [
+    # ("llama3.2:3b-instruct-q4_K_M", 0.3),
+    # ("llama3.1:8b-instruct-q4_K_M", 0.6),
+]
+OLLAMA_ROUTER_MAX_QUEUE_DEPTH = 0  # Route everything to OLLAMA_MODEL while more generations are waiting
+OLLAMA_ROUTER_LATENCY_BUDGET_SECONDS = 30  # Skip a model whose recent tokens/sec predict a slower reply
+
+# Generation Queue Configuration
+GENERATION_MAX_CONCURRENT = 4  # Match OLLAMA_NUM_PARALLEL (times the number of Ollama servers)
+GENERATION_MAX_QUEUE = 16  # Waiting generations per process before chat returns 429
+
+# Chat Job Configuration (/api/chat/jobs)
+CHAT_JOB_WORKERS = 4  # Background generation threads per process, independent of WSGI threads
+CHAT_JOB_MAX_PENDING = 100  # Jobs waiting for a worker before submissions return 429
+CHAT_JOB_MAX_WAIT_SECONDS = 30  # Longest long-poll allowed by ?wait=
+CHAT_SAVE_PARTIAL_REPLIES = True  # Keep the text generated before the user pressed stop
+
+# Rate Limit Configuration
+RATE_LIMIT_ENABLED = True
+RATE_LIMIT_DATABASE = "ratelimit.db"  # Separate file so limiter writes never wait on chat writes
+RATE_LIMIT_SYNC_SECONDS = 1.0  # How often each process merges its buckets into the database; other processes see its requests this late
+# Route class -> {scope: (burst size, requests per minute)}; for auth, "user" is the login name tried
+RATE_LIMITS = {
+    'chat': {'user': (10, 20), 'ip': (30, 60)},
+    'auth': {'user': (5, 5), 'ip': (20, 20)},
+}
+
+# Password Hashing Configuration
+PASSWORD_HASH_METHOD = "scrypt:32768:8:1"  # Werkzeug method and cost; older hashes are upgraded on login
+PASSWORD_HASH_WORKERS = 2  # Hashing processes per app process (0 hashes on the request thread)
+PASSWORD_HASH_MAX_PENDING = 16  # Hash operations in flight before login/signup return 503
+
+# Chat Write-Behind Configuration
+CHAT_WRITE_BEHIND_ENABLED = False  # Queue finished turns and commit them in batches from one writer thread
+CHAT_WRITE_BEHIND_DURABILITY = "group"  # "group": reply waits for its batch to commit; "async": reply returns first (a crash can lose the last batch)
+CHAT_WRITE_BEHIND_SYNCHRONOUS = None  # Writer's PRAGMA synchronous, e.g. "FULL" to fsync every batch (None keeps NORMAL)
+CHAT_WRITE_BEHIND_MAX_BATCH = 64  # Turns per commit at most
+CHAT_WRITE_BEHIND_MAX_DELAY_MS = 20  # Longest a queued turn waits for its batch to fill
+
+# Health Monitor Configuration
+OLLAMA_HEALTH_INTERVAL = 15  # Seconds between background probes of Ollama
+HEALTH_EVENTS_MAX_SUBSCRIBERS = 0  # Status streams per process; each holds a WSGI thread, so 0 (off) makes the UI poll
+HEALTH_EVENTS_MAX_SECONDS = 300  # Streams close after this long and the browser reconnects
+
+# Conversation Memory Configuration
+# Used when a session has no reusable Ollama context (new model, legacy sessions)
+CONVERSATION_TOKEN_BUDGET = 1500  # Approximate prompt tokens for summary + recent turns
+CONVERSATION_SUMMARY_MIN_TURNS = 4  # Older turns to collect before updating the summary
+
+# Response Cache Configuration
+RESPONSE_CACHE_ENABLED = True
+RESPONSE_CACHE_MEMORY_ENTRIES = 1000  # Per-process LRU tier
+RESPONSE_CACHE_MAX_ENTRIES = 10000  # Shared SQLite tier
+RESPONSE_CACHE_TTL_SECONDS = 86400
+
+# Semantic Cache Configuration
+# Paraphrase matching behind the response cache; needs an embedding model (ollama pull nomic-embed-text)
+# and is much faster with NumPy installed (pip install numpy)
+SEMANTIC_CACHE_ENABLED = False
+SEMANTIC_CACHE_MODEL = "nomic-embed-text"
+SEMANTIC_CACHE_THRESHOLD = 0.95  # Cosine similarity a prompt needs to reuse a cached reply
+SEMANTIC_CACHE_MAX_ENTRIES = 5000  # Per process
+SEMANTIC_CACHE_MAX_MEMORY_MB = 64  # Vectors plus replies, per process
+
+# Chat History Configuration
+CHAT_HISTORY_PAGE_SIZE = 50  # Messages per page when loading or scrolling back
+CHAT_HISTORY_MAX_PAGE_SIZE = 200  # Upper bound for ?limit=
+
+# Search Configuration (/api/search)
+SEARCH_PAGE_SIZE = 20  # Hits per page
+SEARCH_MAX_PAGE_SIZE = 100  # Upper bound for ?limit=
+SEARCH_MAX_RESULTS = 500  # Matches ranked together, newest first; older ones are paged to with ?before=
 
 # Session Configuration
 SESSION_LIFETIME_HOURS = 1
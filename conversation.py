@@ -0,0 +1,152 @@
+"""
+Token-budgeted conversation windowing
+Builds multi-turn prompts from chat_messages for sessions without a reusable
+Ollama context. Recent turns are kept verbatim within a token budget and older
+turns are folded into a rolling summary that is updated incrementally.
+"""
+
+from contextlib import nullcontext
+
+import requests
+
+# Upper bound on verbatim turns considered, regardless of budget
+MAX_WINDOW_TURNS = 50
+
+SUMMARY_PROMPT = """You maintain a short running summary of a conversation between a user and an AI assistant.
+Update the summary so it also covers the new turns. Keep names, facts, decisions and open questions.
+Reply with the updated summary only, in at most {max_words} words.
+
+Current summary:
+{summary}
+
+New turns:
+{turns}"""
+
+
+def estimate_tokens(text):
+    """Cheap token estimate (about 4 characters per token for English text)"""
+    return len(text) // 4 + 1
+
+
+def format_turn(message, response):
+    """Render one stored chat turn as transcript text"""
+    return f"User: {message}\nAssistant: {response}"
+
+
+class ConversationWindow:
+    """Builds prompts for a session under a token budget
+
+    keep_alive, if given, is called for the keep_alive to send with summary
+    requests, so they don't reset the model's unload timer to Ollama's default.
+    slot, if given, is called with a user id for a context manager that holds
+    a generation slot (GenerationScheduler.slot) around each summary request.
+    """
+
+    def __init__(self, db, ollama, model, token_budget=1500, summary_min_turns=4, summary_max_words=150,
+                 keep_alive=None, slot=None):
+        self.db = db
+        self.ollama = ollama
+        self.model = model
+        self.keep_alive = keep_alive
+        self.slot = slot or (lambda user_id: nullcontext())
+        self.token_budget = token_budget
+        self.summary_min_turns = summary_min_turns
+        self.summary_max_words = summary_max_words
+
+    def build_prompt(self, session_id, message, user_id=None):
+        """Return the prompt for a new message, including as much history as fits"""
+        summary, summarized_through = self._load_summary(session_id)
+        budget = self.token_budget - estimate_tokens(message) - estimate_tokens(summary or '')
+
+        # Newest turns first, stopping once the verbatim budget is used up
+        recent = self.db.query_all('''
+            SELECT id, message, response FROM chat_messages
+            WHERE session_id = ?
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        ''', (session_id, MAX_WINDOW_TURNS))
+
+        window = []
+        for turn_id, turn_message, turn_response in recent:
+            text = format_turn(turn_message, turn_response)
+            cost = estimate_tokens(text)
+            if cost > budget:
+                break
+            budget -= cost
+            window.append((turn_id, text, cost))
+        window.reverse()
+
+        if not recent:
+            return message
+
+        # Fold turns that fell out of the window into the summary
+        oldest_kept = window[0][0] if window else recent[0][0] + 1
+        old_summary = summary
+        summary = self._update_summary(session_id, summary, summarized_through, oldest_kept, user_id)
+
+        # A longer summary eats into the verbatim budget, so drop the oldest turns to fit
+        budget -= estimate_tokens(summary or '') - estimate_tokens(old_summary or '')
+        while window and budget < 0:
+            budget += window.pop(0)[2]
+
+        parts = []
+        if summary:
+            parts.append(f"Summary of the earlier conversation:\n{summary}")
+        if window:
+            parts.append('\n\n'.join(text for _, text, _ in window))
+        parts.append(f"User: {message}\nAssistant:")
+        return '\n\n'.join(parts)
+
+    def _load_summary(self, session_id):
+        """Return (summary, last summarized message id) for a session"""
+        row = self.db.query_one('''
+            SELECT summary, summarized_through_id FROM chat_session_summaries
+            WHERE session_id = ?
+        ''', (session_id,))
+        return (row[0], row[1]) if row else (None, 0)
+
+    def _update_summary(self, session_id, summary, summarized_through, oldest_kept, user_id=None):
+        """Extend the rolling summary with unsummarized turns older than the window"""
+        pending = self.db.query_all('''
+            SELECT id, message, response FROM chat_messages
+            WHERE session_id = ? AND id > ? AND id < ?
+            ORDER BY id
+            LIMIT ?
+        ''', (session_id, summarized_through, oldest_kept, MAX_WINDOW_TURNS))
+
+        # Batch updates so the summarizer doesn't run on every turn
+        if len(pending) < self.summary_min_turns:
+            return summary
+
+        turns = '\n\n'.join(format_turn(m, r) for _, m, r in pending)
+        prompt = SUMMARY_PROMPT.format(max_words=self.summary_max_words,
+                                       summary=summary or '(none yet)', turns=turns)
+        payload = {
+            "model": self.model,
+            "prompt": prompt,
+            "options": {"num_predict": self.summary_max_words * 2}
+        }
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive()
+        try:
+            # Summaries count towards the generation limit in user_id's turn, like replies
+            with self.slot(user_id):
+                response = self.ollama.generate(payload)
+            if response.status_code != 200:
+                print(f"⚠️ Summary update failed: HTTP {response.status_code}")
+                return summary
+            new_summary = response.json().get('response', '').strip()
+        except requests.exceptions.RequestException as e:
+            print(f"⚠️ Summary update failed: {e}")
+            return summary
+
+        if not new_summary:
+            return summary
+
+        with self.db.transaction() as cursor:
+            cursor.execute('''
+                INSERT OR REPLACE INTO chat_session_summaries (session_id, summary, summarized_through_id, updated_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            ''', (session_id, new_summary, pending[-1][0]))
+        print(f"📝 Summarized {len(pending)} older turns for session {session_id}")
+        return new_summary
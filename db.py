@@ -0,0 +1,137 @@
+"""
+SQLite data-access layer
+Reuses one connection per thread, runs in WAL mode with tuned pragmas and
+keeps a per-connection prepared statement cache.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import metrics
+
+
+class Database:
+    """Thread-local SQLite connection pool"""
+
+    def __init__(self, path, busy_timeout_ms=5000, cached_statements=256, timing_window=1000):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cached_statements = cached_statements
+        # Label for this database's /metrics series
+        self.name = os.path.basename(path)
+        self._local = threading.local()
+        # Recent (transaction, commit) durations in seconds, for latency percentiles
+        self._timings = deque(maxlen=timing_window)
+        self._timings_lock = threading.Lock()
+
+    def _connect(self):
+        """Open and configure a new connection"""
+        # isolation_level=None: reads never hold a transaction open, writes use transaction()
+        conn = sqlite3.connect(self.path,
+                               timeout=self.busy_timeout_ms / 1000,
+                               isolation_level=None,
+                               cached_statements=self.cached_statements)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+        return conn
+
+    def connection(self):
+        """Return this thread's connection, opening it on first use"""
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        # Connections must not cross a fork, so reopen in child processes
+        if conn is None or local.pid != os.getpid():
+            conn = self._connect()
+            local.conn = conn
+            local.pid = os.getpid()
+            local.depth = 0
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Run a block in one write transaction; nested blocks join the outer one"""
+        conn = self.connection()
+        local = self._local
+        if local.depth == 0:
+            started = time.perf_counter()
+            # IMMEDIATE takes the write lock up front so lock upgrades cannot deadlock
+            self._run(conn, 'BEGIN IMMEDIATE')
+        local.depth += 1
+        try:
+            yield conn.cursor()
+        except BaseException:
+            local.depth -= 1
+            if local.depth == 0:
+                conn.execute('ROLLBACK')
+            raise
+        else:
+            local.depth -= 1
+            if local.depth == 0:
+                commit_started = time.perf_counter()
+                self._run(conn, 'COMMIT')
+                finished = time.perf_counter()
+                with self._timings_lock:
+                    self._timings.append((finished - started, finished - commit_started))
+                metrics.DB_TRANSACTION_SECONDS.observe(finished - started, self.name)
+                metrics.DB_COMMIT_SECONDS.observe(finished - commit_started, self.name)
+
+    def transaction_stats(self):
+        """Return latency percentiles (ms) for recent write transactions"""
+        with self._timings_lock:
+            timings = list(self._timings)
+        if not timings:
+            return {'transactions': 0}
+        
+        held = [t[0] for t in timings]
+        commits = [t[1] for t in timings]
+        return {
+            'transactions': len(timings),
+            'transaction_ms_p50': metrics.percentile_ms(held, 0.50),
+            'transaction_ms_p99': metrics.percentile_ms(held, 0.99),
+            'commit_ms_p50': metrics.percentile_ms(commits, 0.50),
+            'commit_ms_p99': metrics.percentile_ms(commits, 0.99),
+        }
+
+    def _run(self, conn, sql):
+        """Execute a transaction control statement, counting SQLite errors (e.g. busy) for /metrics"""
+        try:
+            conn.execute(sql)
+        except sqlite3.Error as e:
+            metrics.count_error('db', e)
+            raise
+
+    def _timed(self, sql, params, fetch=None):
+        """Execute a statement (and fetch its rows), recording its time and SQLite errors"""
+        started = time.perf_counter()
+        try:
+            cursor = self.connection().execute(sql, params)
+            return fetch(cursor) if fetch else cursor
+        except sqlite3.Error as e:
+            metrics.count_error('db', e)
+            raise
+        finally:
+            metrics.DB_QUERY_SECONDS.observe(time.perf_counter() - started, self.name)
+
+    def execute(self, sql, params=()):
+        """Execute a single statement on this thread's connection"""
+        return self._timed(sql, params)
+
+    def query_one(self, sql, params=()):
+        """Return the first row of a query, or None"""
+        return self._timed(sql, params, sqlite3.Cursor.fetchone)
+
+    def query_all(self, sql, params=()):
+        """Return all rows of a query"""
+        return self._timed(sql, params, sqlite3.Cursor.fetchall)
+
+    def close(self):
+        """Close this thread's connection"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
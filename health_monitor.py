@@ -0,0 +1,71 @@
+"""
+Background Ollama health monitor
+Probes Ollama on its own schedule and keeps the latest status in memory, so
+health requests are answered from a snapshot instead of hitting Ollama.
+Subscribers can block until the status changes instead of polling.
+"""
+
+import threading
+import time
+
+from background import BackgroundThreads
+
+
+class HealthMonitor:
+    """Periodically runs a probe and publishes its result"""
+
+    def __init__(self, probe, interval=15.0):
+        self.probe = probe
+        self.interval = interval
+        self._status = None
+        self._checked_at = None
+        self._version = 0
+        self._cond = threading.Condition()
+        self._threads = BackgroundThreads([('ollama-health-monitor', self._run)])
+        self._wake = threading.Event()
+
+    def start(self):
+        """Start the probe thread in this process if it isn't running"""
+        self._threads.start()
+
+    def _run(self):
+        while True:
+            self.refresh()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def refresh(self):
+        """Run the probe now and publish the result"""
+        try:
+            status = self.probe()
+        except Exception as e:
+            status = {'status': 'unhealthy', 'error': str(e)}
+        with self._cond:
+            if status != self._status:
+                if self._status is not None and status.get('status') != self._status.get('status'):
+                    print(f"🩺 Ollama status changed: {self._status.get('status')} -> {status.get('status')}")
+                self._status = status
+                self._version += 1
+                self._cond.notify_all()
+            self._checked_at = time.time()
+
+    def probe_soon(self):
+        """Ask the probe thread to check again without waiting for the interval"""
+        self._wake.set()
+
+    def snapshot(self):
+        """Return the latest status, probing synchronously only the first time"""
+        self.start()
+        with self._cond:
+            has_status = self._status is not None
+        if not has_status:
+            self.refresh()
+        with self._cond:
+            return dict(self._status, version=self._version, checked_at=self._checked_at)
+
+    def wait_for_change(self, version, timeout):
+        """Block until the status version differs from version (or timeout); return the snapshot"""
+        self.start()
+        with self._cond:
+            self._cond.wait_for(lambda: self._version != version, timeout)
+        return self.snapshot()
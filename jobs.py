@@ -0,0 +1,251 @@
+"""
+Background chat jobs
+Submitting a message returns a job id straight away. A pool of worker threads
+runs the generation and stores the result in chat_jobs, so web threads stay
+free while Ollama works and chat concurrency no longer depends on them.
+Clients collect the result with a long-poll, and can cancel a job that is
+still queued or running. The queue itself lives in process memory, so each
+process heartbeats the jobs it holds; jobs whose process went away (restart,
+mod_wsgi recycling) stop being touched and are failed once they go stale.
+"""
+
+import json
+import queue
+import threading
+import time
+import uuid
+
+from background import BackgroundThreads
+
+# Finished jobs are deleted after this long
+JOB_RETENTION_SECONDS = 86400
+# Delete expired jobs once per this many submissions
+PURGE_INTERVAL = 100
+# Long-polls re-read the table this often in case another process ran the job
+POLL_INTERVAL = 1.0
+# Jobs held by a process are touched this often, which also picks up cancellations made elsewhere
+HEARTBEAT_INTERVAL = 5.0
+# Queued or running jobs untouched for this long belong to a process that has gone away
+STALE_JOB_SECONDS = 60
+LOST_JOB_ERROR = 'The server restarted before this job finished. Please send the message again.'
+
+FINISHED_STATUSES = ('done', 'error', 'cancelled')
+
+
+class JobQueueFullError(Exception):
+    """Raised when too many jobs are already waiting for a worker"""
+
+    def __init__(self, pending):
+        super().__init__(f"{pending} chat jobs are already pending")
+        self.pending = pending
+
+
+class ChatJobQueue:
+    """Runs chat turns on worker threads and records their results"""
+
+    def __init__(self, db, run, workers=4, max_pending=100):
+        self.db = db
+        self.run = run  # run(user_id, session_id, message, cancel=Event, **options) -> result dict
+        self.workers = workers
+        self.max_pending = max_pending
+        self._queue = queue.Queue()
+        self._threads = BackgroundThreads(
+            [(f'chat-job-worker-{i}', self._work) for i in range(workers)] + [('chat-job-heartbeat', self._heartbeat)])
+        self._lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._version = 0
+        # job_id -> threading.Event for jobs waiting or running in this process
+        self._cancels = {}
+        self._counters = {'submitted': 0, 'completed': 0, 'failed': 0, 'cancelled': 0}
+
+    def start(self):
+        """Start the worker and heartbeat threads in this process if they aren't running"""
+        self._threads.start()
+
+    def submit(self, user_id, session_id, message, **options):
+        """Queue a chat turn and return its job id"""
+        self.start()
+        pending = self._queue.qsize()
+        if pending >= self.max_pending:
+            raise JobQueueFullError(pending)
+
+        job_id = uuid.uuid4().hex
+        with self.db.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO chat_jobs (id, user_id, session_id, message)
+                VALUES (?, ?, ?, ?)
+            ''', (job_id, user_id, session_id, message))
+        cancel = threading.Event()
+        with self._lock:
+            self._cancels[job_id] = cancel
+        self._queue.put((job_id, user_id, session_id, message, cancel, options))
+
+        with self._lock:
+            self._counters['submitted'] += 1
+            purge = self._counters['submitted'] % PURGE_INTERVAL == 0
+        if purge:
+            self.purge()
+        return job_id
+
+    def _work(self):
+        while True:
+            job_id, user_id, session_id, message, cancel, options = self._queue.get()
+            try:
+                # Skip jobs cancelled while they were waiting (possibly from another process)
+                if not self._update(job_id, 'running', expected='queued'):
+                    continue
+                try:
+                    result = self.run(user_id, session_id, message, cancel=cancel, **options)
+                except Exception as e:
+                    print(f"❌ Chat job {job_id} failed: {e}")
+                    self._update(job_id, 'error', error=str(e), expected='running')
+                    self._count('failed')
+                else:
+                    if not cancel.is_set() and self._update(job_id, 'done', result=result, expected='running'):
+                        self._count('completed')
+                    else:
+                        # Cancelled here or from another process before the heartbeat
+                        # noticed: keep the (partial) result alongside the cancelled status
+                        self._update(job_id, 'cancelled', result=result, expected='cancelled')
+            finally:
+                with self._lock:
+                    self._cancels.pop(job_id, None)
+
+    def _heartbeat(self):
+        while True:
+            try:
+                self._touch()
+                self.recover_stale()
+            except Exception as e:
+                print(f"⚠️ Chat job heartbeat failed: {e}")
+            time.sleep(HEARTBEAT_INTERVAL)
+
+    def _touch(self):
+        """Mark this process's jobs as alive and stop any that were cancelled from another process"""
+        with self._lock:
+            job_ids = list(self._cancels)
+        if not job_ids:
+            return
+        placeholders = ','.join('?' * len(job_ids))
+        with self.db.transaction() as cursor:
+            cursor.execute(f'''
+                UPDATE chat_jobs SET updated_at = CURRENT_TIMESTAMP
+                WHERE id IN ({placeholders}) AND status IN ('queued', 'running')
+            ''', job_ids)
+            cursor.execute(f'''
+                SELECT id FROM chat_jobs WHERE id IN ({placeholders}) AND status = 'cancelled'
+            ''', job_ids)
+            cancelled = [row[0] for row in cursor.fetchall()]
+        with self._lock:
+            events = [self._cancels.get(job_id) for job_id in cancelled]
+        for event in events:
+            if event is not None:
+                event.set()
+
+    def recover_stale(self):
+        """Fail queued or running jobs that no process is heartbeating any more"""
+        cutoff = f'-{STALE_JOB_SECONDS} seconds'
+        # Check first so that an idle heartbeat doesn't take the write lock
+        if self.db.query_one('''
+            SELECT 1 FROM chat_jobs
+            WHERE status IN ('queued', 'running') AND updated_at < datetime('now', ?) LIMIT 1
+        ''', (cutoff,)) is None:
+            return 0
+        with self.db.transaction() as cursor:
+            cursor.execute('''
+                UPDATE chat_jobs SET status = 'error', error = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE status IN ('queued', 'running') AND updated_at < datetime('now', ?)
+            ''', (LOST_JOB_ERROR, cutoff))
+            recovered = cursor.rowcount
+        print(f"🧹 Failed {recovered} chat jobs left behind by a stopped process")
+        self._notify()
+        return recovered
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _update(self, job_id, status, result=None, error=None, expected=None):
+        """Record a job's status (only if it is currently expected) and wake up long-polls
+
+        Returns True if the job was updated.
+        """
+        with self.db.transaction() as cursor:
+            cursor.execute('''
+                UPDATE chat_jobs SET status = ?, result = ?, error = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = ?
+            ''', (status, json.dumps(result) if result is not None else None, error, job_id, expected))
+            updated = cursor.rowcount > 0
+        self._notify()
+        return updated
+
+    def _notify(self):
+        with self._cond:
+            self._version += 1
+            self._cond.notify_all()
+
+    def cancel(self, job_id, user_id):
+        """Cancel a queued or running job owned by user_id and return it, or None"""
+        with self.db.transaction() as cursor:
+            cursor.execute('''
+                UPDATE chat_jobs SET status = 'cancelled', updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND user_id = ? AND status IN ('queued', 'running')
+            ''', (job_id, user_id))
+            cancelled = cursor.rowcount > 0
+        if cancelled:
+            # A running job stops at its next token; one still queued is skipped
+            with self._lock:
+                event = self._cancels.get(job_id)
+                self._counters['cancelled'] += 1
+            if event is not None:
+                event.set()
+            self._notify()
+        return self.get(job_id, user_id)
+
+    def get(self, job_id, user_id):
+        """Return a job owned by user_id, or None"""
+        row = self.db.query_one('''
+            SELECT id, session_id, status, result, error, created_at, updated_at
+            FROM chat_jobs WHERE id = ? AND user_id = ?
+        ''', (job_id, user_id))
+        if row is None:
+            return None
+        job = {'job_id': row[0], 'session_id': row[1], 'status': row[2],
+               'created_at': row[5], 'updated_at': row[6]}
+        if row[3]:
+            job.update(json.loads(row[3]))
+        if row[4]:
+            job['error'] = row[4]
+        return job
+
+    def wait(self, job_id, user_id, timeout):
+        """Long-poll: return the job once it has finished or timeout has passed"""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._cond:
+                version = self._version
+            job = self.get(job_id, user_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job['status'] in FINISHED_STATUSES or remaining <= 0:
+                return job
+            with self._cond:
+                self._cond.wait_for(lambda: self._version != version, min(POLL_INTERVAL, remaining))
+
+    def purge(self):
+        """Delete jobs past the retention period
+
+        Live jobs are heartbeated, so a queued or running one this old was
+        left behind by a stopped process and is deleted too.
+        """
+        with self.db.transaction() as cursor:
+            cursor.execute('''
+                DELETE FROM chat_jobs WHERE updated_at < datetime('now', ?)
+            ''', (f'-{JOB_RETENTION_SECONDS} seconds',))
+
+    def stats(self):
+        """Job counters and backlog for this process"""
+        with self._lock:
+            stats = dict(self._counters)
+        stats['pending'] = self._queue.qsize()
+        stats['workers'] = self.workers
+        return stats
@@ -0,0 +1,218 @@
+"""
+Prometheus metrics
+Counters and histograms for the request, SQLite and Ollama hot paths,
+rendered in the Prometheus text format by /metrics. Each thread updates one
+of a fixed set of lock stripes, so request threads rarely wait on each other;
+a scrape sums the stripes. Values cover the process that serves the scrape,
+which is the whole app with the single mod_wsgi daemon process configured in
+apache-flaskapp.conf.
+"""
+
+import itertools
+import math
+import threading
+from bisect import bisect_left
+
+# Lock stripes per metric; threads are spread across them round-robin
+STRIPES = 16
+
+_next_stripe = itertools.count()
+_thread_stripe = threading.local()
+
+# Every metric, in the order it is rendered
+REGISTRY = []
+
+
+def _stripe():
+    """This thread's stripe index"""
+    index = getattr(_thread_stripe, 'index', None)
+    if index is None:
+        index = _thread_stripe.index = next(_next_stripe) % STRIPES
+    return index
+
+
+def percentile_ms(values, pct):
+    """The pct (0..1) percentile of durations in seconds, in milliseconds, for the JSON health stats"""
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * pct))] * 1000, 3)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=''):
+    """{name="value",...} for a sample, or '' without labels"""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    """A named metric whose values are kept per label set in lock stripes"""
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._stripes = [(threading.Lock(), {}) for _ in range(STRIPES)]
+        REGISTRY.append(self)
+
+    def _merged(self, empty, merge):
+        """{label values: value} summed over all stripes"""
+        merged = {}
+        for lock, values in self._stripes:
+            with lock:
+                items = [(key, list(value) if isinstance(value, list) else value) for key, value in values.items()]
+            for key, value in items:
+                merged[key] = merge(merged.get(key, empty()), value)
+        return merged
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(Metric):
+    """Monotonic count, e.g. requests or tokens"""
+
+    kind = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        lock, values = self._stripes[_stripe()]
+        with lock:
+            values[label_values] = values.get(label_values, 0) + amount
+
+    def _samples(self):
+        merged = self._merged(int, lambda total, value: total + value)
+        for key in sorted(merged):
+            yield f'{self.name}{_format_labels(self.labels, key)} {_format_value(merged[key])}'
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets, plus their sum and count"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=()):
+        super().__init__(name, documentation, labels)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value, *label_values):
+        # bisect_left finds the first bucket with value <= its upper bound (le)
+        index = bisect_left(self.buckets, value)
+        lock, values = self._stripes[_stripe()]
+        with lock:
+            counts = values.get(label_values)
+            if counts is None:
+                # One count per bucket plus +Inf, then the sum of observed values
+                counts = values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def _samples(self):
+        size = len(self.buckets) + 2
+        merged = self._merged(lambda: [0] * size, lambda total, value: [a + b for a, b in zip(total, value)])
+        for key in sorted(merged):
+            counts = merged[key]
+            cumulative = 0
+            for bound, count in zip(self.buckets + [math.inf], counts):
+                cumulative += count
+                labels = _format_labels(self.labels, key, f'le="{_format_value(bound)}"')
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labels, key)
+            yield f'{self.name}_sum{labels} {_format_value(counts[-1])}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+class Gauge(Metric):
+    """Current value read from a callable when scraped, e.g. a queue depth"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, read):
+        super().__init__(name, documentation)
+        self.read = read
+
+    def _samples(self):
+        yield f'{self.name} {_format_value(self.read())}'
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+OLLAMA_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'chatapp_http_request_duration_seconds',
+    'Time from request start until the response body was sent (streams included)',
+    ('method', 'route', 'status'), HTTP_BUCKETS)
+DB_QUERY_SECONDS = Histogram(
+    'chatapp_db_query_duration_seconds', 'SQLite statement time, except on transaction cursors',
+    ('db',), DB_BUCKETS)
+DB_TRANSACTION_SECONDS = Histogram(
+    'chatapp_db_transaction_duration_seconds', 'Time a SQLite write transaction held the write lock',
+    ('db',), DB_BUCKETS)
+DB_COMMIT_SECONDS = Histogram(
+    'chatapp_db_commit_duration_seconds', 'SQLite COMMIT time', ('db',), DB_BUCKETS)
+OLLAMA_TTFT_SECONDS = Histogram(
+    'chatapp_ollama_time_to_first_token_seconds',
+    'Time to the first reply token (measured for streams; load plus prompt eval otherwise)',
+    ('model', 'stream'), OLLAMA_BUCKETS)
+OLLAMA_REQUEST_SECONDS = Histogram(
+    'chatapp_ollama_generation_duration_seconds', 'Time from sending a generation until its last token',
+    ('model', 'stream'), OLLAMA_BUCKETS)
+OLLAMA_TOKENS_PER_SECOND = Histogram(
+    'chatapp_ollama_tokens_per_second', 'Prompt evaluation and reply generation speed per generation',
+    ('model', 'phase'), RATE_BUCKETS)
+OLLAMA_TOKENS = Counter(
+    'chatapp_ollama_tokens_total', 'Tokens evaluated (prompt) and generated (eval)', ('model', 'phase'))
+OLLAMA_TOKEN_SECONDS = Counter(
+    'chatapp_ollama_token_seconds_total', 'Ollama time spent on prompt evaluation and generation',
+    ('model', 'phase'))
+ERRORS = Counter(
+    'chatapp_errors_total', 'Errors by component and exception class or HTTP status', ('component', 'error'))
+
+
+def observe_generation(model, data, seconds, ttft=None):
+    """Record a finished Ollama generation from its final response fields
+
+    ttft is the measured time to the first token of a stream; for other
+    generations Ollama's load and prompt eval durations stand in for it.
+    """
+    stream = 'false' if ttft is None else 'true'
+    if ttft is None:
+        ttft = ((data.get('load_duration') or 0) + (data.get('prompt_eval_duration') or 0)) / 1e9
+    OLLAMA_TTFT_SECONDS.observe(ttft, model, stream)
+    OLLAMA_REQUEST_SECONDS.observe(seconds, model, stream)
+    for phase, count_field, duration_field in (('prompt', 'prompt_eval_count', 'prompt_eval_duration'),
+                                               ('eval', 'eval_count', 'eval_duration')):
+        count = data.get(count_field) or 0
+        duration = (data.get(duration_field) or 0) / 1e9
+        OLLAMA_TOKENS.inc(model, phase, amount=count)
+        OLLAMA_TOKEN_SECONDS.inc(model, phase, amount=duration)
+        if count and duration:
+            OLLAMA_TOKENS_PER_SECOND.observe(count / duration, model, phase)
+
+
+def count_error(component, error):
+    """Count an exception (by class name) or an error label such as 'HTTP 503'"""
+    ERRORS.inc(component, error if isinstance(error, str) else type(error).__name__)
@@ -0,0 +1,314 @@
+"""
+Versioned schema migrations
+The schema version is tracked in SQLite's PRAGMA user_version. Migrations run
+inside one BEGIN IMMEDIATE transaction, so when several WSGI processes start at
+once only one of them applies a step and the others see the new version.
+"""
+
+# Milliseconds a starting process waits for another process that holds the migration lock
+MIGRATION_LOCK_TIMEOUT_MS = 120000
+
+
+def create_base_schema(cursor):
+    """Create the original tables and apply the legacy session_id migration"""
+    # Create users table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            phone TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Create chat sessions table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            title TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    
+    # Create chat history table (updated with session_id)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id INTEGER,
+            user_id INTEGER,
+            message TEXT NOT NULL,
+            response TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES chat_sessions (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    
+    # Migration: Add session_id column if it doesn't exist
+    try:
+        cursor.execute("PRAGMA table_info(chat_messages)")
+        columns = cursor.fetchall()
+        column_names = [col[1] for col in columns]
+        
+        if 'session_id' not in column_names:
+            print("🔄 Migrating database: Adding session_id column...")
+            cursor.execute('ALTER TABLE chat_messages ADD COLUMN session_id INTEGER')
+            
+            # For existing messages, create default sessions
+            cursor.execute('SELECT DISTINCT user_id FROM chat_messages WHERE session_id IS NULL')
+            users_with_messages = cursor.fetchall()
+            
+            for (user_id,) in users_with_messages:
+                cursor.execute('''
+                    INSERT INTO chat_sessions (user_id, title, created_at, updated_at)
+                    VALUES (?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                ''', (user_id, 'Migrated Chat'))
+                
+                session_id = cursor.lastrowid
+                cursor.execute('''
+                    UPDATE chat_messages 
+                    SET session_id = ? 
+                    WHERE user_id = ? AND session_id IS NULL
+                ''', (session_id, user_id))
+            
+            print("✅ Database migration completed!")
+    except Exception as e:
+        print(f"Migration check failed: {e}")
+
+
+def add_hot_path_indexes(cursor):
+    """Index the lookups used by chat history, the session list and ownership checks"""
+    # History and previews read one session's messages in time order
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_messages_session_created
+        ON chat_messages (session_id, created_at)
+    ''')
+    # The sidebar lists a user's sessions by last activity
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_sessions_user_updated
+        ON chat_sessions (user_id, updated_at)
+    ''')
+    # The default session is the user's most recently created one
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_sessions_user_created
+        ON chat_sessions (user_id, created_at)
+    ''')
+    cursor.execute('ANALYZE')
+
+
+def format_session_preview(message, response):
+    """Build the sidebar preview text for a session's latest turn"""
+    if message and response:
+        # Show both user message and AI response
+        return f"You: {message[:40]}{'...' if len(message) > 40 else ''}\nAI: {response[:40]}{'...' if len(response) > 40 else ''}"
+    if message:
+        # Only user message exists
+        return f"You: {message[:60]}{'...' if len(message) > 60 else ''}"
+    return None
+
+
+def add_session_summaries(cursor):
+    """Denormalize message count, last preview and last activity onto chat_sessions"""
+    cursor.execute('ALTER TABLE chat_sessions ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('ALTER TABLE chat_sessions ADD COLUMN last_message_preview TEXT')
+    cursor.execute('ALTER TABLE chat_sessions ADD COLUMN last_activity TIMESTAMP')
+    
+    # Backfill from existing messages using the (session_id, created_at) index
+    cursor.execute('''
+        UPDATE chat_sessions
+        SET message_count = (SELECT COUNT(*) FROM chat_messages WHERE session_id = chat_sessions.id),
+            last_activity = (SELECT MAX(created_at) FROM chat_messages WHERE session_id = chat_sessions.id)
+    ''')
+    latest = cursor.execute('''
+        SELECT m.session_id, m.message, m.response
+        FROM chat_sessions s
+        JOIN chat_messages m ON m.id = (
+            SELECT id FROM chat_messages
+            WHERE session_id = s.id
+            ORDER BY created_at DESC, id DESC
+            LIMIT 1
+        )
+    ''').fetchall()
+    cursor.executemany(
+        'UPDATE chat_sessions SET last_message_preview = ? WHERE id = ?',
+        ((format_session_preview(message, response), session_id)
+         for session_id, message, response in latest))
+
+
+def add_session_contexts(cursor):
+    """Store each session's Ollama KV context so the next turn can reuse it"""
+    # Kept out of chat_sessions so the sidebar listing doesn't read large blobs
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_session_contexts (
+            session_id INTEGER PRIMARY KEY,
+            model TEXT NOT NULL,
+            context BLOB NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES chat_sessions (id)
+        )
+    ''')
+
+
+def add_session_summaries_table(cursor):
+    """Cache a rolling summary of turns that no longer fit in the prompt window"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_session_summaries (
+            session_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            summarized_through_id INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES chat_sessions (id)
+        )
+    ''')
+
+
+def add_response_cache(cursor):
+    """Shared tier of the exact-match response cache"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            last_used REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_response_cache_last_used
+        ON response_cache (last_used)
+    ''')
+
+
+def add_chat_jobs(cursor):
+    """Background chat generations and their results"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_jobs (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            session_id INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            result TEXT,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (session_id) REFERENCES chat_sessions (id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_jobs_status_updated
+        ON chat_jobs (status, updated_at)
+    ''')
+
+
+def add_message_search(cursor):
+    """Full-text index over messages and responses, kept in sync by triggers"""
+    # The index reads its text back from this view (external content), so messages aren't
+    # stored twice. owner holds a "u<user_id>" token: matching it in the same query scopes
+    # a search to one user's rows instead of ranking every user's matches.
+    cursor.execute('''
+        CREATE VIEW IF NOT EXISTS chat_messages_search_source AS
+        SELECT id, message, response, 'u' || user_id AS owner FROM chat_messages
+    ''')
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts USING fts5(
+            message, response, owner,
+            content='chat_messages_search_source', content_rowid='id',
+            tokenize='porter unicode61'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS chat_messages_fts_insert AFTER INSERT ON chat_messages BEGIN
+            INSERT INTO chat_messages_fts (rowid, message, response, owner)
+            VALUES (new.id, new.message, new.response, 'u' || new.user_id);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS chat_messages_fts_delete AFTER DELETE ON chat_messages BEGIN
+            INSERT INTO chat_messages_fts (chat_messages_fts, rowid, message, response, owner)
+            VALUES ('delete', old.id, old.message, old.response, 'u' || old.user_id);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS chat_messages_fts_update
+        AFTER UPDATE OF message, response, user_id ON chat_messages BEGIN
+            INSERT INTO chat_messages_fts (chat_messages_fts, rowid, message, response, owner)
+            VALUES ('delete', old.id, old.message, old.response, 'u' || old.user_id);
+            INSERT INTO chat_messages_fts (rowid, message, response, owner)
+            VALUES (new.id, new.message, new.response, 'u' || new.user_id);
+        END
+    ''')
+    # Index existing history
+    cursor.execute("INSERT INTO chat_messages_fts (chat_messages_fts) VALUES ('rebuild')")
+
+
+def add_message_models(cursor):
+    """Record which model answered each message (NULL for messages saved before routing)"""
+    # The search view and triggers name their columns, so they are unaffected
+    cursor.execute('ALTER TABLE chat_messages ADD COLUMN model TEXT')
+
+
+def add_message_stopped(cursor):
+    """Flag replies the user stopped, instead of a marker in the reply text"""
+    cursor.execute('ALTER TABLE chat_messages ADD COLUMN stopped INTEGER NOT NULL DEFAULT 0')
+    # Partial replies used to be saved with " ⏹️" appended (3 characters); the update trigger reindexes them
+    cursor.execute('''
+        UPDATE chat_messages
+        SET response = substr(response, 1, length(response) - 3), stopped = 1
+        WHERE response LIKE '% ⏹️'
+    ''')
+
+
+# (version, description, function) in the order they must be applied
+MIGRATIONS = [
+    (1, 'base schema', create_base_schema),
+    (2, 'hot-path indexes', add_hot_path_indexes),
+    (3, 'session summaries', add_session_summaries),
+    (4, 'session contexts', add_session_contexts),
+    (5, 'conversation summaries', add_session_summaries_table),
+    (6, 'response cache', add_response_cache),
+    (7, 'chat jobs', add_chat_jobs),
+    (8, 'message search', add_message_search),
+    (9, 'message models', add_message_models),
+    (10, 'stopped replies', add_message_stopped),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(db):
+    """Return the schema version recorded in the database"""
+    return db.query_one('PRAGMA user_version')[0]
+
+
+def migrate(db, target=None):
+    """Apply all pending migrations up to target (default: latest)"""
+    target = LATEST_VERSION if target is None else target
+    
+    # Fast path: nothing to do, so don't take the write lock
+    if get_schema_version(db) >= target:
+        return
+    
+    conn = db.connection()
+    # Index builds on large databases can take a while, so wait longer than usual
+    conn.execute(f'PRAGMA busy_timeout={MIGRATION_LOCK_TIMEOUT_MS}')
+    try:
+        with db.transaction() as cursor:
+            # Re-read under the lock: another process may have migrated meanwhile
+            version = cursor.execute('PRAGMA user_version').fetchone()[0]
+            starting_version = version
+            for step, description, apply in MIGRATIONS:
+                if version < step <= target:
+                    print(f"🔄 Applying database migration {step}: {description}...")
+                    apply(cursor)
+                    cursor.execute(f'PRAGMA user_version = {step}')
+                    version = step
+        if version != starting_version:
+            print(f"✅ Database schema is at version {version}")
+    finally:
+        conn.execute(f'PRAGMA busy_timeout={int(db.busy_timeout_ms)}')
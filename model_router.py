@@ -0,0 +1,147 @@
+"""
+Per-request model routing
+Sends each chat message to one of several models: the small default model
+for short, simple messages and larger models for long or hard ones. A larger
+model is only chosen while the generation queue is short and its recent
+tokens/sec predict a reply within the latency budget, so under load every
+request falls back to the small model.
+"""
+
+import re
+import threading
+import time
+from collections import deque
+
+# Complexity points for message length, reached at this many words
+LONG_MESSAGE_WORDS = 200
+# Generations per model used for the rolling rates
+RATE_WINDOW = 50
+
+# Words that usually ask for reasoning rather than a quick answer
+_REASONING = re.compile(
+    r'\b(explain|why|compare|analy[sz]e|design|prove|derive|debug|refactor|optimi[sz]e|'
+    r'trade-?offs?|pros and cons|step[- ]by[- ]step|in detail|architecture|algorithm)\b',
+    re.IGNORECASE)
+_CODE = re.compile(r'```|^(?: {4}|\t)\S|\b(?:def|class|function|SELECT|import)\b|[{};]\s*$', re.MULTILINE)
+
+
+def complexity(message):
+    """Cheap 0..1 estimate of how much a message benefits from a larger model"""
+    score = 0.4 * min(len(message.split()) / LONG_MESSAGE_WORDS, 1.0)
+    if _CODE.search(message):
+        score += 0.3
+    score += 0.15 * min(len(_REASONING.findall(message)), 3)
+    if message.count('?') > 1:
+        score += 0.1
+    return round(min(score, 1.0), 3)
+
+
+class ModelRouter:
+    """Chooses the model for a message and keeps per-model generation rates
+
+    models is a list of (model, min_complexity) for the larger models, from
+    smallest to largest. A message goes to the largest model whose
+    min_complexity it reaches, stepping down while the queue is deeper than
+    max_queue_depth, a model's estimated reply time exceeds latency_budget
+    seconds, or the model recently turned out not to be installed.
+    """
+
+    def __init__(self, default_model, models=(), queue_depth=None, max_queue_depth=0,
+                 latency_budget=30.0, unavailable_seconds=300):
+        self.default_model = default_model
+        self.models = sorted(models, key=lambda item: item[1])
+        self.queue_depth = queue_depth or (lambda: 0)
+        self.max_queue_depth = max_queue_depth
+        self.latency_budget = latency_budget
+        self.unavailable_seconds = unavailable_seconds
+        self._lock = threading.Lock()
+        # model -> deque of (prompt tokens/sec, reply tokens/sec, reply tokens)
+        self._rates = {}
+        self._unavailable_until = {}
+        self._routed = {}
+        self._counters = {'fallback_load': 0, 'fallback_latency': 0, 'fallback_unavailable': 0}
+
+    def _averages(self, model):
+        """(prompt tokens/sec, reply tokens/sec, reply tokens) for model, or None (lock held)"""
+        samples = self._rates.get(model)
+        if not samples:
+            return None
+        return tuple(sum(column) / len(samples) for column in zip(*samples))
+
+    def estimate_seconds(self, model, prompt_tokens):
+        """Predicted generation time for a prompt, or None before model has been measured"""
+        with self._lock:
+            averages = self._averages(model)
+        if averages is None:
+            return None
+        prompt_rate, reply_rate, reply_tokens = averages
+        return prompt_tokens / prompt_rate + reply_tokens / reply_rate
+
+    def choose(self, message, prompt_tokens):
+        """Return the model to answer message, whose full prompt is about prompt_tokens long"""
+        score = complexity(message)
+        chosen = self.default_model
+        candidates = [model for model, min_complexity in self.models if score >= min_complexity]
+        if candidates and self.queue_depth() > self.max_queue_depth:
+            with self._lock:
+                self._counters['fallback_load'] += 1
+            candidates = []
+
+        now = time.monotonic()
+        for model in reversed(candidates):
+            if self._unavailable_until.get(model, 0) > now:
+                with self._lock:
+                    self._counters['fallback_unavailable'] += 1
+                continue
+            # Unmeasured models are tried so that they get measured
+            estimate = self.estimate_seconds(model, prompt_tokens)
+            if estimate is not None and estimate > self.latency_budget:
+                with self._lock:
+                    self._counters['fallback_latency'] += 1
+                continue
+            chosen = model
+            break
+
+        with self._lock:
+            self._routed[chosen] = self._routed.get(chosen, 0) + 1
+        if chosen != self.default_model:
+            print(f"🧭 Routing to {chosen} (complexity {score})")
+        return chosen
+
+    def record(self, model, result):
+        """Fold the durations of a finished Ollama generation into model's rates"""
+        prompt_tokens = result.get('prompt_eval_count') or 0
+        prompt_ns = result.get('prompt_eval_duration') or 0
+        reply_tokens = result.get('eval_count') or 0
+        reply_ns = result.get('eval_duration') or 0
+        if not (prompt_tokens and prompt_ns and reply_tokens and reply_ns):
+            return
+        with self._lock:
+            samples = self._rates.setdefault(model, deque(maxlen=RATE_WINDOW))
+            samples.append((prompt_tokens / prompt_ns * 1e9, reply_tokens / reply_ns * 1e9, reply_tokens))
+
+    def mark_unavailable(self, model):
+        """Stop routing to a model Ollama doesn't have, for unavailable_seconds"""
+        print(f"⚠️ {model} is not installed; routing to {self.default_model} instead")
+        with self._lock:
+            self._unavailable_until[model] = time.monotonic() + self.unavailable_seconds
+
+    def stats(self):
+        """Routing counts and rolling rates per model for this process"""
+        with self._lock:
+            stats = dict(self._counters)
+            routed = dict(self._routed)
+            models = {}
+            for model in [self.default_model] + [model for model, _ in self.models]:
+                averages = self._averages(model)
+                models[model] = {'routed': routed.get(model, 0)}
+                if averages is not None:
+                    models[model].update({
+                        'prompt_tokens_per_s': round(averages[0], 1),
+                        'tokens_per_s': round(averages[1], 1),
+                        'avg_reply_tokens': round(averages[2]),
+                    })
+        stats['models'] = models
+        stats['max_queue_depth'] = self.max_queue_depth
+        stats['latency_budget_s'] = self.latency_budget
+        return stats
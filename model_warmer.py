@@ -0,0 +1,123 @@
+"""
+Model warm-up and keep_alive management
+Loading a model into memory takes seconds, and Ollama unloads a model once
+its keep_alive expires. The warmer loads the chat model (and any extra warm
+models) on every server at startup, reloads them when a check finds them
+unloaded, and picks a keep_alive for each request that outlasts the gap
+between recent requests, so the model stays loaded while people are using
+it and is released when traffic stops.
+"""
+
+import threading
+import time
+from collections import deque
+
+from background import BackgroundThreads
+
+# keep_alive covers this many times the average gap between recent requests
+KEEP_ALIVE_GAP_FACTOR = 4
+# Request times used for the average gap
+TRAFFIC_WINDOW = 50
+# Checks to skip before retrying a load that failed (e.g. the model isn't installed there)
+FAILED_LOAD_BACKOFF_CHECKS = 10
+
+
+def model_name(name):
+    """Ollama's canonical name for a model ("mistral" -> "mistral:latest")"""
+    return name if ':' in name else f'{name}:latest'
+
+
+class ModelWarmer:
+    """Keeps the chat model and warm_models loaded on every Ollama server
+
+    The chat model is reloaded only while the app has been active (started
+    or served a request) within max_keep_alive seconds; warm_models are
+    loaded with keep_alive=-1 so Ollama never unloads them.
+    """
+
+    def __init__(self, ollama, model, warm_models=(), min_keep_alive=300, max_keep_alive=3600,
+                 interval=60, timeout=5):
+        self.ollama = ollama
+        self.model = model
+        self.warm_models = list(warm_models)
+        self.min_keep_alive = min_keep_alive
+        self.max_keep_alive = max_keep_alive
+        self.interval = interval
+        self.timeout = timeout
+        self._requests = deque(maxlen=TRAFFIC_WINDOW)
+        self._last_activity = time.monotonic()
+        self._lock = threading.Lock()
+        self._threads = BackgroundThreads([('model-warmer', self._run)], on_start=self._on_start)
+        self._loads = {}  # model -> {'loaded_at', 'seconds'} of its last warm-up
+        self._retry_at = {}  # (url, model) -> when to retry a failed load
+        self._counters = {'warmups': 0, 'warmup_failures': 0}
+
+    def start(self):
+        """Warm the models now and keep them warm, in a thread of this process"""
+        self._threads.start()
+
+    def _on_start(self, forked):
+        with self._lock:
+            self._last_activity = time.monotonic()
+
+    def record_request(self):
+        """Note a chat request for the traffic estimate"""
+        with self._lock:
+            self._last_activity = time.monotonic()
+            self._requests.append(self._last_activity)
+
+    def keep_alive(self):
+        """keep_alive (seconds) for a chat request, covering the expected gap to the next one"""
+        with self._lock:
+            times = list(self._requests)
+        if len(times) < 2:
+            return self.max_keep_alive
+        average_gap = (times[-1] - times[0]) / (len(times) - 1)
+        return int(min(self.max_keep_alive, max(self.min_keep_alive, average_gap * KEEP_ALIVE_GAP_FACTOR)))
+
+    def _wanted(self):
+        """(model, keep_alive) for the models that should be loaded right now"""
+        wanted = [(model, -1) for model in self.warm_models]
+        with self._lock:
+            idle = time.monotonic() - self._last_activity
+        # Once nobody has used the chat model for a while, let Ollama release it
+        if idle < self.max_keep_alive:
+            wanted.insert(0, (self.model, self.keep_alive()))
+        return wanted
+
+    def _run(self):
+        while True:
+            self.check()
+            time.sleep(self.interval)
+
+    def check(self):
+        """Load any wanted model that isn't loaded on a reachable server"""
+        loaded = self.ollama.loaded_models(timeout=(self.timeout, self.timeout))
+        for model, keep_alive in self._wanted():
+            for url, models in loaded.items():
+                if model_name(model) in {model_name(name) for name in models}:
+                    continue
+                if self._retry_at.get((url, model), 0) > time.monotonic():
+                    continue
+                print(f"🔥 Loading {model} on {url}...")
+                try:
+                    seconds = self.ollama.load_model(url, model, keep_alive)
+                except Exception as e:
+                    print(f"⚠️ Could not load {model} on {url}: {e}")
+                    self._retry_at[(url, model)] = time.monotonic() + self.interval * FAILED_LOAD_BACKOFF_CHECKS
+                    with self._lock:
+                        self._counters['warmup_failures'] += 1
+                    continue
+                print(f"✅ {model} loaded on {url} in {seconds:.1f}s")
+                with self._lock:
+                    self._counters['warmups'] += 1
+                    self._loads[model] = {'loaded_at': time.time(), 'seconds': round(seconds, 2)}
+
+    def stats(self):
+        """Warm-up counters, last load times and the current keep_alive"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['last_loads'] = dict(self._loads)
+        stats['models'] = [self.model] + self.warm_models
+        stats['keep_alive_s'] = self.keep_alive()
+        return stats
@@ -0,0 +1,388 @@
+"""
+Shared Ollama HTTP client
+Keeps a bounded keep-alive connection pool per process, separates connect,
+first-byte and total timeouts, and retries idempotent calls with jittered backoff.
+"""
+
+import json
+import os
+import random
+import sys
+import threading
+import time
+from array import array
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from circuit_breaker import CircuitOpenError
+
+# Status codes worth retrying on an idempotent call
+RETRY_STATUS_CODES = (502, 503, 504)
+
+
+def pack_context(tokens):
+    """Encode an Ollama context token list as little-endian uint32 bytes"""
+    data = array('I', tokens)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data.tobytes()
+
+
+def unpack_context(blob):
+    """Decode bytes written by pack_context() back into a token list"""
+    data = array('I')
+    data.frombytes(blob)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data.tolist()
+
+
+class OllamaClient:
+    """Pooled client for the Ollama REST API"""
+
+    def __init__(self, base_url, pool_size=10, connect_timeout=3.0,
+                 first_byte_timeout=30.0, total_timeout=120.0,
+                 max_retries=2, backoff_base=0.25, backoff_max=2.0):
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.first_byte_timeout = first_byte_timeout
+        self.total_timeout = total_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._http = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _session(self):
+        """Return the pooled session, rebuilding it after a fork"""
+        pid = os.getpid()
+        if self._http is None or self._pid != pid:
+            with self._lock:
+                if self._http is None or self._pid != pid:
+                    http = requests.Session()
+                    # pool_block keeps the number of open sockets bounded under load
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size,
+                                          pool_block=True, max_retries=0)
+                    http.mount('http://', adapter)
+                    http.mount('https://', adapter)
+                    self._http = http
+                    self._pid = pid
+        return self._http
+
+    def _backoff(self, attempt):
+        """Full-jitter exponential backoff delay for a retry attempt"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def request(self, method, path, payload=None, timeout=None, stream=False, idempotent=None):
+        """Send a request, retrying only when the call is idempotent"""
+        if idempotent is None:
+            idempotent = method in ('GET', 'HEAD')
+        if timeout is None:
+            timeout = (self.connect_timeout, self.first_byte_timeout)
+        url = f"{self.base_url}{path}"
+        attempts = 1 + (self.max_retries if idempotent else 0)
+
+        for attempt in range(attempts):
+            try:
+                response = self._session().request(method, url, json=payload,
+                                                   timeout=timeout, stream=stream)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt + 1 >= attempts:
+                    raise
+                print(f"🔁 Retrying {method} {path} after error: {e}")
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt + 1 >= attempts:
+                    return response
+                response.close()
+                print(f"🔁 Retrying {method} {path} after HTTP {response.status_code}")
+            time.sleep(self._backoff(attempt))
+
+    def get(self, path, timeout=None):
+        """GET an Ollama endpoint (retried on transient failures)"""
+        return self.request('GET', path, timeout=timeout)
+
+    def tags(self, timeout=None):
+        """List the models installed on the Ollama server"""
+        response = self.get('/api/tags', timeout=timeout)
+        response.raise_for_status()
+        return response.json().get('models', [])
+
+    def generate(self, payload):
+        """Run a non-streaming generation and return the response object"""
+        payload = dict(payload, stream=False)
+        # Without streaming the first byte is the whole reply, so cap it by the total budget
+        timeout = (self.connect_timeout, min(self.first_byte_timeout, self.total_timeout))
+        return self.request('POST', '/api/generate', payload, timeout=timeout)
+
+    def embed(self, payload):
+        """Embed text with an embedding model (retried like a GET: it has no side effects)"""
+        return self.request('POST', '/api/embed', payload, idempotent=True)
+
+    def stream_generate(self, payload):
+        """Open a streaming generation; use with iter_chunks() to read it"""
+        payload = dict(payload, stream=True)
+        return self.request('POST', '/api/generate', payload, stream=True)
+
+    def iter_chunks(self, response):
+        """Yield decoded stream chunks, enforcing the total timeout"""
+        deadline = time.monotonic() + self.total_timeout
+        try:
+            for line in response.iter_lines():
+                if time.monotonic() > deadline:
+                    raise requests.exceptions.Timeout(
+                        f"Generation exceeded total timeout of {self.total_timeout}s")
+                if line:
+                    yield json.loads(line)
+        finally:
+            response.close()
+
+
+class Backend:
+    """Routing state for one Ollama server"""
+
+    def __init__(self, client):
+        self.client = client
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.models = set()
+        self.latency = None  # Moving average of seconds until response headers
+
+    @property
+    def url(self):
+        return self.client.base_url
+
+
+class OllamaLoadBalancer:
+    """Routes generations across several Ollama servers
+
+    Picks the backend with the fewest outstanding requests weighted by its
+    recent latency, preferring backends that have the requested model, and
+    retries once on another backend when the first one errors. A backend is
+    ejected after consecutive failures and re-admitted once a probe of
+    /api/tags succeeds. An optional circuit breaker sees the outcome of each
+    call after failover and rejects calls while open. Exposes the same calls
+    as OllamaClient.
+    """
+
+    def __init__(self, clients, max_failures=3, eject_seconds=30.0, latency_alpha=0.3, breaker=None):
+        self.backends = [Backend(client) for client in clients]
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.latency_alpha = latency_alpha
+        self.breaker = breaker
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return ', '.join(backend.url for backend in self.backends)
+
+    def _choose(self, model=None, exclude=()):
+        """Reserve the best backend for a request"""
+        now = time.monotonic()
+        with self._lock:
+            available = [b for b in self.backends if b not in exclude]
+            candidates = [b for b in available if b.ejected_until <= now]
+            if not candidates:
+                # Everything is ejected: try the one that has been out the longest
+                candidates = [min(available, key=lambda b: b.ejected_until)]
+            if model:
+                with_model = [b for b in candidates if model in b.models]
+                candidates = with_model or candidates
+
+            # Backends without a latency sample yet are assumed to be average
+            measured = [b.latency for b in self.backends if b.latency is not None]
+            default_latency = sum(measured) / len(measured) if measured else 1.0
+            backend = min(candidates, key=lambda b: (b.outstanding + 1) * (b.latency or default_latency))
+            backend.outstanding += 1
+            return backend
+
+    def _release(self, backend, ok):
+        """Record the outcome of a request and free its slot"""
+        with self._lock:
+            backend.outstanding -= 1
+            if ok:
+                backend.consecutive_failures = 0
+            else:
+                self._record_failure(backend)
+
+    def _record_latency(self, backend, latency):
+        """Fold a time-to-headers sample into the backend's moving average"""
+        with self._lock:
+            backend.latency = latency if backend.latency is None else (
+                self.latency_alpha * latency + (1 - self.latency_alpha) * backend.latency)
+
+    def _record_failure(self, backend):
+        """Count a failure and eject the backend at max_failures (caller holds the lock)"""
+        backend.consecutive_failures += 1
+        now = time.monotonic()
+        if backend.consecutive_failures >= self.max_failures and backend.ejected_until <= now:
+            backend.ejected_until = now + self.eject_seconds
+            print(f"🚫 Ejecting Ollama backend {backend.url} after {backend.consecutive_failures} failures")
+
+    def _send(self, model, call, stream=False):
+        """Run call(client) through the breaker on a chosen backend, counting errors for /metrics"""
+        if self.breaker is not None and not self.breaker.allow():
+            metrics.count_error('ollama', 'CircuitOpenError')
+            raise CircuitOpenError(self.breaker.retry_after())
+        try:
+            response = self._send_with_failover(model, call, stream)
+        except requests.exceptions.RequestException as e:
+            metrics.count_error('ollama', e)
+            if self.breaker is not None:
+                self.breaker.record_failure()
+            raise
+        if response.status_code >= 400:
+            metrics.count_error('ollama', f'HTTP {response.status_code}')
+        if self.breaker is not None:
+            if response.status_code >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+        return response
+
+    def _send_with_failover(self, model, call, stream=False):
+        """Run call(client) on a chosen backend, failing over once if it is down
+
+        Only a refused or timed-out connection, or a 5xx answer, is sent to
+        another backend. After a read timeout the first backend may still be
+        generating, so the request is not sent again (generations are never retried).
+        """
+        tried = []
+        while True:
+            backend = self._choose(model, exclude=tried)
+            tried.append(backend)
+            can_fail_over = len(tried) < min(2, len(self.backends))
+            started = time.monotonic()
+            try:
+                response = call(backend.client)
+            except (requests.exceptions.ConnectionError, requests.exceptions.ConnectTimeout):
+                self._release(backend, ok=False)
+                if can_fail_over:
+                    continue
+                raise
+            except requests.exceptions.RequestException:
+                self._release(backend, ok=False)
+                raise
+            except BaseException:
+                self._release(backend, ok=True)
+                raise
+
+            self._record_latency(backend, time.monotonic() - started)
+            if response.status_code >= 500:
+                self._release(backend, ok=False)
+                if can_fail_over:
+                    response.close()
+                    continue
+                return response
+            if stream and response.status_code == 200:
+                # The slot stays taken until iter_chunks() has read the whole stream
+                response.ollama_backend = backend
+            else:
+                self._release(backend, ok=True)
+            return response
+
+    def get(self, path, timeout=None):
+        return self._send(None, lambda client: client.get(path, timeout=timeout))
+
+    def generate(self, payload):
+        return self._send(payload.get('model'), lambda client: client.generate(payload))
+
+    def embed(self, payload):
+        return self._send(payload.get('model'), lambda client: client.embed(payload))
+
+    def stream_generate(self, payload):
+        return self._send(payload.get('model'), lambda client: client.stream_generate(payload), stream=True)
+
+    def iter_chunks(self, response):
+        """Yield stream chunks and release the backend once the stream ends"""
+        backend = response.ollama_backend
+        ok = True
+        try:
+            yield from backend.client.iter_chunks(response)
+        except requests.exceptions.RequestException as e:
+            ok = False
+            metrics.count_error('ollama', e)
+            if self.breaker is not None:
+                self.breaker.record_failure()
+            raise
+        finally:
+            self._release(backend, ok)
+
+    def probe_backends(self, timeout=None):
+        """Check every backend's /api/tags, refreshing its model list and ejection state"""
+        statuses = []
+        for backend in self.backends:
+            try:
+                response = backend.client.request('GET', '/api/tags', timeout=timeout, idempotent=False)
+                healthy = response.status_code == 200
+                models = {m.get('name') for m in response.json().get('models', [])} if healthy else set()
+                loaded = set()
+                if healthy:
+                    # Installed models aren't necessarily in memory; /api/ps lists those that are
+                    response = backend.client.request('GET', '/api/ps', timeout=timeout, idempotent=False)
+                    if response.status_code == 200:
+                        loaded = {m.get('name') for m in response.json().get('models', [])}
+            except (requests.exceptions.RequestException, ValueError):
+                healthy, models, loaded = False, set(), set()
+
+            with self._lock:
+                if healthy:
+                    backend.models = models
+                    if backend.ejected_until > time.monotonic():
+                        print(f"✅ Re-admitting Ollama backend {backend.url}")
+                    backend.ejected_until = 0.0
+                    backend.consecutive_failures = 0
+                else:
+                    self._record_failure(backend)
+                ejected = backend.ejected_until > time.monotonic()
+            statuses.append({'url': backend.url, 'healthy': healthy, 'ejected': ejected,
+                             'models': sorted(models), 'loaded': sorted(loaded)})
+        return statuses
+
+    def loaded_models(self, timeout=None):
+        """Return {url: set of models loaded in memory (/api/ps)} for reachable backends"""
+        loaded = {}
+        for backend in self.backends:
+            try:
+                response = backend.client.request('GET', '/api/ps', timeout=timeout, idempotent=False)
+                if response.status_code == 200:
+                    loaded[backend.url] = {m.get('name') for m in response.json().get('models', [])}
+            except (requests.exceptions.RequestException, ValueError):
+                pass
+        return loaded
+
+    def load_model(self, url, model, keep_alive):
+        """Load a model into memory on one backend with an empty generation
+
+        Returns the seconds it took. Bypasses the breaker: loading can take
+        far longer than a normal request and is not a sign of failure.
+        """
+        backend = next(b for b in self.backends if b.url == url)
+        timeout = (backend.client.connect_timeout, backend.client.total_timeout)
+        started = time.monotonic()
+        response = backend.client.request(
+            'POST', '/api/generate', {'model': model, 'prompt': '', 'keep_alive': keep_alive, 'stream': False},
+            timeout=timeout)
+        if response.status_code == 400:
+            # Embedding models don't support generate; an empty embed loads them instead
+            response = backend.client.request(
+                'POST', '/api/embed', {'model': model, 'input': '', 'keep_alive': keep_alive}, timeout=timeout)
+        response.raise_for_status()
+        return time.monotonic() - started
+
+    def stats(self):
+        """Current routing state per backend"""
+        now = time.monotonic()
+        with self._lock:
+            return [{
+                'url': b.url,
+                'outstanding': b.outstanding,
+                'consecutive_failures': b.consecutive_failures,
+                'ejected': b.ejected_until > now,
+                'latency_ms': round(b.latency * 1000, 1) if b.latency is not None else None,
+            } for b in self.backends]
@@ -10,10 +10,15 @@ import json
 import subprocess
 import sys
 import os
+from ollama_client import OllamaClient
 
 OLLAMA_URL = "http://localhost:11434"
 REQUIRED_MODEL = "llama3.2:1b-instruct-q4_K_M"
 
+# The service is polled repeatedly below, so reuse one keep-alive connection.
+# Retries are disabled because main() already has its own wait loop.
+ollama = OllamaClient(OLLAMA_URL, pool_size=1, first_byte_timeout=30, max_retries=0)
+
 def check_docker():
     """Check if Docker is running"""
     try:
@@ -44,7 +49,7 @@ def start_ollama_container():
 def check_ollama_health():
     """Check if Ollama service is responding"""
     try:
-        response = requests.get(f"{OLLAMA_URL}/api/tags", timeout=5)
+        response = ollama.get('/api/tags', timeout=5)
         return response.status_code == 200
     except:
         return False
@@ -52,7 +57,7 @@ def check_ollama_health():
 def get_available_models():
     """Get list of available models"""
     try:
-        response = requests.get(f"{OLLAMA_URL}/api/tags", timeout=5)
+        response = ollama.get('/api/tags', timeout=5)
         if response.status_code == 200:
             data = response.json()
             return [model.get('name', '') for model in data.get('models', [])]
@@ -80,7 +85,7 @@ def test_model(model_name):
             "stream": False
         }
         
-        response = requests.post(f"{OLLAMA_URL}/api/generate", json=payload, timeout=30)
+        response = ollama.generate(payload)
         
         if response.status_code == 200:
             data = response.json()
@@ -0,0 +1,119 @@
+"""
+Password hashing off the request threads
+Hashing and verifying are CPU-bound and hold the GIL, so they run in a small
+process pool; a burst of logins then can't stall chat requests served by the
+same process. Stored hashes made with an older method or cost are upgraded
+the next time their owner logs in.
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from metrics import percentile_ms
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many hash operations are already waiting, or one took too long"""
+
+
+def _run(operation, args):
+    """Pool worker: run one hash operation and time it"""
+    started = time.perf_counter()
+    if operation == 'hash':
+        result = generate_password_hash(*args)
+    else:
+        result = check_password_hash(*args)
+    return result, time.perf_counter() - started
+
+
+class PasswordHasher:
+    """Hashes and verifies passwords in a bounded process pool
+
+    method is a werkzeug hash method with its cost, e.g. "scrypt:32768:8:1"
+    or "pbkdf2:sha256:600000". With workers=0 everything runs inline.
+    """
+
+    def __init__(self, method='scrypt:32768:8:1', workers=2, max_pending=16, timeout=30.0, timing_window=200):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pool = None
+        self._pid = None
+        self._prefix = None
+        self._lock = threading.Lock()
+        self._timings = {'hash': deque(maxlen=timing_window), 'verify': deque(maxlen=timing_window)}
+
+    def _executor(self):
+        """Return the process pool, creating it in this process on first use"""
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                # Workers only ever run _run(), so forking from a threaded server is safe enough
+                # and avoids spawn re-executing sys.executable (which is Apache under mod_wsgi)
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('fork'))
+                self._pid = os.getpid()
+            return self._pool
+
+    def _call(self, operation, *args):
+        """Run an operation in the pool and record its latency"""
+        # Reject at once: waiting for a slot would hold a request thread instead
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy('Too many password operations in progress')
+        started = time.perf_counter()
+        if self.workers:
+            try:
+                future = self._executor().submit(_run, operation, args)
+            except BaseException:
+                self._slots.release()
+                raise
+            # The slot is freed when the pool finishes the work, not when we stop waiting for it
+            future.add_done_callback(lambda _: self._slots.release())
+            try:
+                result, compute = future.result(timeout=self.timeout)
+            except FutureTimeoutError:
+                raise PasswordHasherBusy(f'Password {operation} took longer than {self.timeout}s')
+        else:
+            try:
+                result, compute = _run(operation, args)
+            finally:
+                self._slots.release()
+        with self._lock:
+            self._timings[operation].append((time.perf_counter() - started, compute))
+        return result
+
+    def hash(self, password):
+        """Hash a password with the configured method"""
+        return self._call('hash', password, self.method)
+
+    def verify(self, password_hash, password):
+        """Check a password against a stored hash (any supported method)"""
+        return self._call('verify', password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """True if a stored hash was made with a different method or cost"""
+        if self._prefix is None:
+            # werkzeug fills in default costs ("scrypt" -> "scrypt:32768:8:1"), so ask it once
+            self._prefix = self.hash('').split('$', 1)[0]
+        return password_hash.split('$', 1)[0] != self._prefix
+
+    def stats(self):
+        """Latency percentiles (ms) per operation: total includes waiting for a worker"""
+        stats = {'method': self.method, 'workers': self.workers}
+        with self._lock:
+            timings = {operation: list(samples) for operation, samples in self._timings.items()}
+        for operation, samples in timings.items():
+            stats[f'{operation}_count'] = len(samples)
+            if samples:
+                total = [sample[0] for sample in samples]
+                compute = [sample[1] for sample in samples]
+                stats[f'{operation}_ms_p50'] = percentile_ms(total, 0.50)
+                stats[f'{operation}_ms_p99'] = percentile_ms(total, 0.99)
+                stats[f'{operation}_compute_ms_p50'] = percentile_ms(compute, 0.50)
+        return stats
@@ -0,0 +1,189 @@
+"""
+Token-bucket rate limiting shared by all worker processes
+Each bucket is kept in GCRA form, as one "theoretical arrival time" (tat), so
+refilling and taking a token is a single comparison. Requests are checked
+against the buckets in process memory, which takes microseconds; a
+background thread merges the tokens this process took into a SQLite table
+every sync_interval seconds and reads back what other processes took. With
+one worker process (apache-flaskapp.conf) the limits are exact; with several,
+each may admit what the others took during the last sync interval. The
+state lives in its own database file so limiter writes never wait on chat
+writes, and buckets survive restarts.
+"""
+
+import math
+import threading
+import time
+
+from background import BackgroundThreads
+
+# Delete refilled buckets from the database once per this many syncs
+CLEANUP_INTERVAL = 100
+# Keys per statement when reading buckets back (below SQLite's parameter limit)
+SYNC_CHUNK = 500
+
+
+class RateLimitDecision:
+    """Outcome of a rate limit check, with the values for the response headers"""
+
+    def __init__(self, allowed, limit, remaining, reset, retry_after=0):
+        self.allowed = allowed
+        self.limit = limit
+        self.remaining = remaining
+        self.reset = reset
+        self.retry_after = retry_after
+
+    def headers(self):
+        headers = {
+            'X-RateLimit-Limit': str(self.limit),
+            'X-RateLimit-Remaining': str(self.remaining),
+            'X-RateLimit-Reset': str(self.reset),
+        }
+        if not self.allowed:
+            headers['Retry-After'] = str(self.retry_after)
+        return headers
+
+
+class _Bucket:
+    """A bucket's arrival time and the tokens taken here since the last sync"""
+
+    __slots__ = ('tat', 'taken', 'spent')
+
+    def __init__(self, tat):
+        self.tat = tat
+        self.taken = 0
+        # Seconds the taken tokens moved the arrival time
+        self.spent = 0.0
+
+
+def _decision(allowed, tat, now, capacity, interval):
+    """The decision and header values for a bucket whose arrival time is now tat"""
+    # How far the arrival time may run ahead of now: a full bucket's worth
+    window = capacity * interval
+    remaining = max(0, math.floor((window - (tat - now)) / interval + 1e-9))
+    reset = max(0, math.ceil(tat - now))
+    retry_after = 0 if allowed else max(1, math.ceil(tat + interval - window - now))
+    return RateLimitDecision(allowed, capacity, remaining, reset, retry_after)
+
+
+class RateLimiter:
+    """Per-key token buckets for classes of routes
+
+    limits maps a route class to {scope: (capacity, tokens_per_minute)}, e.g.
+    {'chat': {'user': (10, 30), 'ip': (30, 120)}}. A request is allowed only
+    if every scope it is checked against has a token left.
+    """
+
+    def __init__(self, db, limits, sync_interval=1.0):
+        self.db = db
+        self.limits = limits
+        self.sync_interval = sync_interval
+        # key -> _Bucket, for keys whose bucket isn't full
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._syncs = 0
+        self._threads = BackgroundThreads([('rate-limit-sync', self._sync_loop)], on_start=self._on_start)
+
+    def _on_start(self, forked):
+        """Create the bucket table before this process's sync thread starts"""
+        if forked:
+            # The parent's unsynced tokens are the parent's to sync
+            with self._lock:
+                self._buckets = {}
+        # The limiter database has no migrations
+        with self.db.transaction() as cursor:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS rate_limits (
+                    key TEXT PRIMARY KEY,
+                    tat REAL NOT NULL
+                ) WITHOUT ROWID
+            ''')
+
+    def _load(self, keys):
+        """{key: tat} from the shared table for the keys that have a row"""
+        placeholders = ','.join('?' * len(keys))
+        return dict(self.db.query_all(f'SELECT key, tat FROM rate_limits WHERE key IN ({placeholders})', keys))
+
+    def check(self, route_class, **identities):
+        """Take a token for each scope (user=..., ip=...) and return the tightest decision"""
+        self._threads.start()
+        rules = self.limits.get(route_class, {})
+        scopes = [(f'{route_class}:{scope}:{identity}', *rules[scope])
+                  for scope, identity in identities.items() if identity is not None and scope in rules]
+        if not scopes:
+            return None
+        # A key this process hasn't seen may have been spent by another process or before a restart
+        missing = [key for key, _, _ in scopes if key not in self._buckets]
+        loaded = self._load(missing) if missing else {}
+
+        now = time.time()
+        taken = []
+        with self._lock:
+            for key, capacity, per_minute in scopes:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = _Bucket(loaded.get(key, 0.0))
+                interval = 60.0 / per_minute
+                tat = max(bucket.tat, now) + interval
+                if tat - now > capacity * interval:
+                    # Denied requests take no token from any scope
+                    return _decision(False, bucket.tat, now, capacity, interval)
+                taken.append((bucket, tat, capacity, interval))
+            for bucket, tat, _, interval in taken:
+                bucket.tat = tat
+                bucket.taken += 1
+                bucket.spent += interval
+
+        decisions = [_decision(True, tat, now, capacity, interval) for _, tat, capacity, interval in taken]
+        return min(decisions, key=lambda d: d.remaining)
+
+    def _sync_loop(self):
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                self.sync()
+            except Exception as e:
+                print(f"⚠️ Rate limit sync failed: {e}")
+
+    def sync(self):
+        """Merge the tokens taken in this process into the shared table and read back the others'"""
+        with self._lock:
+            pending = [(key, bucket.tat, bucket.taken, bucket.spent)
+                       for key, bucket in self._buckets.items() if bucket.taken]
+            keys = list(self._buckets)
+        if pending:
+            with self.db.transaction() as cursor:
+                # Add what this process spent to the shared arrival time; if nothing else
+                # touched the row, that is exactly this process's arrival time
+                cursor.executemany('''
+                    INSERT INTO rate_limits (key, tat) VALUES (:key, :tat)
+                    ON CONFLICT (key) DO UPDATE SET tat = max(tat + :spent, :tat)
+                ''', [{'key': key, 'tat': tat, 'spent': spent} for key, tat, _, spent in pending])
+
+        shared = {}
+        for i in range(0, len(keys), SYNC_CHUNK):
+            shared.update(self._load(keys[i:i + SYNC_CHUNK]))
+        now = time.time()
+        with self._lock:
+            buckets = self._buckets
+            for key, _, taken, spent in pending:
+                bucket = buckets.get(key)
+                if bucket is not None:
+                    bucket.taken -= taken
+                    bucket.spent -= spent
+            for key, tat in shared.items():
+                bucket = buckets.get(key)
+                if bucket is not None and tat > bucket.tat:
+                    bucket.tat = tat
+            # A refilled bucket is the same as no bucket
+            for key in [key for key, bucket in buckets.items() if bucket.tat < now and not bucket.taken]:
+                del buckets[key]
+
+        self._syncs += 1
+        if self._syncs % CLEANUP_INTERVAL == 0:
+            self.cleanup()
+
+    def cleanup(self):
+        """Drop buckets that have refilled completely (same as having no row)"""
+        with self.db.transaction() as cursor:
+            cursor.execute('DELETE FROM rate_limits WHERE tat < ?', (time.time(),))
@@ -0,0 +1,123 @@
+"""
+Exact-match response cache
+Two tiers: a per-process LRU for millisecond hits and a SQLite table shared by
+every mod_wsgi process. Keys cover the normalized prompt, model and options.
+"""
+
+import hashlib
+import json
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# Run SQLite-tier eviction once per this many writes
+EVICTION_INTERVAL = 100
+
+
+def normalize_prompt(prompt):
+    """Fold case, Unicode forms and whitespace so trivial variants share a key"""
+    return ' '.join(unicodedata.normalize('NFKC', prompt).casefold().split())
+
+
+class ResponseCache:
+    """Two-tier (memory + SQLite) LRU cache of AI replies"""
+
+    def __init__(self, db, max_memory_entries=1000, max_entries=10000, ttl_seconds=86400):
+        self.db = db
+        self.max_memory_entries = max_memory_entries
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._counters = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'bypassed': 0, 'stores': 0}
+
+    def make_key(self, prompt, model, options=None):
+        """Build the cache key for a generation request"""
+        material = json.dumps([normalize_prompt(prompt), model, options or {}], sort_keys=True)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _remember(self, key, response, expires_at):
+        """Insert into the in-process LRU, evicting the least recently used"""
+        with self._lock:
+            self._memory[key] = (response, expires_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, key, bypass=False):
+        """Return the cached reply for key, or None on a miss"""
+        if bypass:
+            self._count('bypassed')
+            return None
+
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._memory.move_to_end(key)
+                    self._counters['memory_hits'] += 1
+                    return entry[0]
+                del self._memory[key]
+
+        row = self.db.query_one('''
+            SELECT response, expires_at FROM response_cache
+            WHERE key = ? AND expires_at > ?
+        ''', (key, now))
+        if row is None:
+            self._count('misses')
+            return None
+
+        # Shared tier hit: refresh its LRU position and keep a local copy
+        with self.db.transaction() as cursor:
+            cursor.execute('UPDATE response_cache SET last_used = ? WHERE key = ?', (now, key))
+        self._remember(key, row[0], row[1])
+        self._count('db_hits')
+        return row[0]
+
+    def put(self, key, response):
+        """Store a reply in both tiers"""
+        now = time.time()
+        expires_at = now + self.ttl_seconds
+        self._remember(key, response, expires_at)
+
+        with self.db.transaction() as cursor:
+            cursor.execute('''
+                INSERT OR REPLACE INTO response_cache (key, response, expires_at, last_used)
+                VALUES (?, ?, ?, ?)
+            ''', (key, response, expires_at, now))
+
+        with self._lock:
+            self._counters['stores'] += 1
+            self._writes += 1
+            evict = self._writes % EVICTION_INTERVAL == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Drop expired rows and trim the shared tier to its size cap"""
+        with self.db.transaction() as cursor:
+            cursor.execute('DELETE FROM response_cache WHERE expires_at <= ?', (time.time(),))
+            cursor.execute('''
+                DELETE FROM response_cache WHERE key IN (
+                    SELECT key FROM response_cache
+                    ORDER BY last_used DESC
+                    LIMIT -1 OFFSET ?
+                )
+            ''', (self.max_entries,))
+
+    def stats(self):
+        """Hit/miss counters for this process plus tier sizes"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['memory_entries'] = len(self._memory)
+        lookups = stats['memory_hits'] + stats['db_hits'] + stats['misses']
+        stats['hit_rate'] = round((stats['memory_hits'] + stats['db_hits']) / lookups, 3) if lookups else 0.0
+        stats['db_entries'] = self.db.query_one('SELECT COUNT(*) FROM response_cache')[0]
+        return stats
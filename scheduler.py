@@ -0,0 +1,145 @@
+"""
+Fair generation scheduler
+Limits how many generations run against Ollama at once and queues the rest.
+Waiting requests are served round-robin across users, so one user sending
+many messages can't starve everyone else, and the queue is bounded so that
+overload turns into a quick 429 instead of a pile of blocked worker threads.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from metrics import percentile_ms
+
+# Assumed generation time before any has been measured
+DEFAULT_GENERATION_SECONDS = 5.0
+
+
+class QueueFullError(Exception):
+    """Raised when a generation can't be queued"""
+
+    def __init__(self, position, estimated_wait):
+        super().__init__(f"Generation queue is full (position {position}, ~{estimated_wait}s wait)")
+        self.position = position
+        self.estimated_wait = estimated_wait
+
+
+class Ticket:
+    """One queued generation"""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.granted = False
+        self.enqueued_at = time.monotonic()
+
+
+class GenerationScheduler:
+    """Concurrency limit plus a bounded per-user round-robin queue"""
+
+    def __init__(self, max_concurrent=4, max_queue=16, timing_window=200):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self._active = 0
+        self._queued = 0
+        # user_id -> deque of tickets; iteration order is the round-robin order
+        self._queues = OrderedDict()
+        self._cond = threading.Condition()
+        self._waits = deque(maxlen=timing_window)
+        self._durations = deque(maxlen=timing_window)
+        self._counters = {'admitted': 0, 'queued': 0, 'rejected': 0, 'completed': 0}
+
+    def _estimate_wait(self, position):
+        """Seconds until the request at position gets a slot (lock held)"""
+        average = sum(self._durations) / len(self._durations) if self._durations else DEFAULT_GENERATION_SECONDS
+        return math.ceil(average * math.ceil(position / self.max_concurrent))
+
+    def _full(self):
+        return self._active >= self.max_concurrent and self._queued >= self.max_queue
+
+    def check_admission(self):
+        """Raise QueueFullError if a new generation would be rejected right now"""
+        with self._cond:
+            if self._full():
+                self._counters['rejected'] += 1
+                position = self._queued + 1
+                raise QueueFullError(position, self._estimate_wait(position))
+
+    def queue_depth(self):
+        """Number of generations waiting for a slot"""
+        with self._cond:
+            return self._queued
+
+    @contextmanager
+    def slot(self, user_id):
+        """Hold a generation slot for the duration of the with block, waiting for a turn"""
+        ticket = Ticket(user_id)
+        with self._cond:
+            if self._active < self.max_concurrent and not self._queued:
+                ticket.granted = True
+                self._active += 1
+            elif self._queued >= self.max_queue:
+                self._counters['rejected'] += 1
+                position = self._queued + 1
+                raise QueueFullError(position, self._estimate_wait(position))
+            else:
+                self._queues.setdefault(user_id, deque()).append(ticket)
+                self._queued += 1
+                self._counters['queued'] += 1
+                while not ticket.granted:
+                    self._cond.wait()
+            self._counters['admitted'] += 1
+            self._waits.append(time.monotonic() - ticket.enqueued_at)
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._counters['completed'] += 1
+                self._durations.append(time.monotonic() - started)
+                self._dispatch()
+
+    def _dispatch(self):
+        """Hand free slots to the next user in rotation (lock held)"""
+        granted = False
+        while self._active < self.max_concurrent and self._queues:
+            user_id, tickets = next(iter(self._queues.items()))
+            ticket = tickets.popleft()
+            # Move this user to the back of the rotation, or drop them if nothing is left
+            del self._queues[user_id]
+            if tickets:
+                self._queues[user_id] = tickets
+            ticket.granted = True
+            self._active += 1
+            self._queued -= 1
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def stats(self):
+        """Queue depth, wait times and generation times for this process"""
+        with self._cond:
+            stats = dict(self._counters)
+            stats.update({
+                'active': self._active,
+                'queued_now': self._queued,
+                'users_waiting': len(self._queues),
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                # What a request arriving now would wait
+                'estimated_wait_s': self._estimate_wait(self._queued + 1) if self._queued else 0,
+            })
+            waits = list(self._waits)
+            durations = list(self._durations)
+
+        if waits:
+            stats['wait_ms_p50'] = percentile_ms(waits, 0.50)
+            stats['wait_ms_p99'] = percentile_ms(waits, 0.99)
+        if durations:
+            stats['generation_ms_p50'] = percentile_ms(durations, 0.50)
+            stats['generation_ms_p99'] = percentile_ms(durations, 0.99)
+        return stats
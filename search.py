@@ -0,0 +1,139 @@
+"""
+Full-text search over a user's chat history
+Queries the chat_messages_fts index (migration 8) for one user's matching
+messages and ranks them. FTS5's bm25() is not used: it computes term
+statistics over every user's rows on each query, which costs hundreds of
+milliseconds for common words on a large history. Instead the user's matches
+are scored here from the highlighted text, with BM25's term-frequency and
+length weighting, a window of the newest ones at a time; older windows are
+reached with a rowid cursor.
+"""
+
+import html
+import re
+
+# Default number of matches ranked together (newest first); older ones form the next window
+MAX_CANDIDATES = 500
+# Words of context shown around the first match in a snippet
+SNIPPET_WORDS = 12
+
+# BM25 term-frequency saturation and length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Control characters used as match markers, swapped for <mark> after escaping
+_MARK_START = '\x02'
+_MARK_END = '\x03'
+
+_TERMS = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def fts_query(text):
+    """Turn search box text into an FTS5 expression, or None if it has no words
+
+    Words must all match (in any order, with stemming, so "deploying" finds
+    "deploy") and "quoted text" matches as a phrase. Operators and
+    punctuation are treated as plain text.
+    """
+    terms = []
+    for phrase, word in _TERMS.findall(text):
+        words = re.findall(r'\w+', phrase or word)
+        if words:
+            terms.append('"' + ' '.join(words) + '"')
+    if not terms:
+        return None
+    return ' '.join(terms)
+
+
+def make_snippet(highlighted):
+    """Cut a highlighted column down to the words around its first match, as HTML"""
+    words = highlighted.split()
+    first = next((i for i, word in enumerate(words) if _MARK_START in word), 0)
+    start = max(0, first - SNIPPET_WORDS // 4)
+    end = start + SNIPPET_WORDS
+    snippet = ' '.join(words[start:end])
+    # A match cut off by the window still needs its closing marker
+    if snippet.count(_MARK_START) > snippet.count(_MARK_END):
+        snippet += _MARK_END
+    snippet = ('…' if start > 0 else '') + snippet + ('…' if end < len(words) else '')
+    return html.escape(snippet).replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>')
+
+
+def score(columns, average_lengths):
+    """BM25-style relevance of one row from its highlighted columns"""
+    total = 0.0
+    for text, average in zip(columns, average_lengths):
+        hits = text.count(_MARK_START)
+        if hits:
+            length = len(text.split())
+            norm = 1 - BM25_B + BM25_B * length / average
+            total += hits * (BM25_K1 + 1) / (hits + BM25_K1 * norm)
+    return total
+
+
+def search_messages(db, user_id, text, limit=20, offset=0, max_candidates=MAX_CANDIDATES, before=None):
+    """Return (hits, next_page) for one page of user_id's messages matching text, best first
+
+    Hits are ranked within a window of the newest max_candidates matches
+    with a rowid below before (if given). next_page is None on the last
+    page, or {'offset': ..., 'before': ...} for the next one: further into
+    this window, or the start of the next older window.
+    """
+    query = fts_query(text)
+    if query is None:
+        return [], None
+
+    # The owner term restricts matching to this user's rows before anything is read
+    match = f'owner : "u{int(user_id)}" AND {{message response}} : ({query})'
+    candidates = db.query_all('''
+        SELECT rowid,
+               highlight(chat_messages_fts, 0, ?, ?),
+               highlight(chat_messages_fts, 1, ?, ?)
+        FROM chat_messages_fts
+        WHERE chat_messages_fts MATCH ? AND rowid < ?
+        ORDER BY rowid DESC
+        LIMIT ?
+    ''', (_MARK_START, _MARK_END, _MARK_START, _MARK_END, match,
+          before if before is not None else 2 ** 63 - 1, max_candidates + 1))
+    # One extra row tells us whether an older window exists
+    older = len(candidates) > max_candidates
+    candidates = candidates[:max_candidates]
+    if not candidates:
+        return [], None
+
+    average_lengths = [max(1.0, sum(len(row[column].split()) for row in candidates) / len(candidates))
+                       for column in (1, 2)]
+    # sorted() is stable, so equally relevant hits stay newest first
+    ranked = sorted(((score(row[1:], average_lengths), row) for row in candidates),
+                    key=lambda item: -item[0])
+    page = ranked[offset:offset + limit]
+
+    placeholders = ','.join('?' * len(page))
+    details = {row[0]: row[1:] for row in db.query_all(f'''
+        SELECT m.id, m.session_id, s.title, m.created_at
+        FROM chat_messages m
+        LEFT JOIN chat_sessions s ON s.id = m.session_id
+        WHERE m.id IN ({placeholders})
+    ''', [row[0] for _, row in page])} if page else {}
+
+    hits = []
+    for relevance, (message_id, message, response) in page:
+        if message_id not in details:
+            continue  # Deleted since the match
+        session_id, title, created_at = details[message_id]
+        hits.append({
+            'message_id': message_id,
+            'session_id': session_id,
+            'session_title': title,
+            'timestamp': created_at,
+            'user_message': make_snippet(message),
+            'ai_response': make_snippet(response),
+            'score': round(relevance, 4),
+        })
+    if offset + limit < len(ranked):
+        next_page = {'offset': offset + limit, 'before': before}
+    elif older:
+        next_page = {'offset': 0, 'before': candidates[-1][0]}
+    else:
+        next_page = None
+    return hits, next_page
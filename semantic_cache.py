@@ -0,0 +1,302 @@
+"""
+Semantic response cache
+Catches the paraphrases the exact-match cache misses ("what is python" and
+"What's Python?"). Prompts are embedded with an Ollama embedding model and
+compared by cosine similarity with the prompts of cached replies; a match
+above the threshold returns that reply without a generation. The index is
+kept in process memory. NumPy, when installed, searches it with one
+matrix-vector product; otherwise a pure-Python scan is used and the index
+is kept small (about 60 ms per lookup at 1000 768-dimension vectors).
+"""
+
+import math
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+from operator import mul
+
+try:
+    import numpy
+except ImportError:  # Optional: pip install numpy
+    numpy = None
+
+from metrics import percentile_ms
+from response_cache import normalize_prompt
+
+# Embeddings from recent lookups, kept so storing the reply doesn't embed the prompt again
+PENDING_EMBEDDINGS = 256
+# Without NumPy each lookup scans every vector in Python, so the index is kept this small
+FALLBACK_MAX_ENTRIES = 1000
+
+# math.sumprod (Python 3.12+) is a C loop; older versions multiply in Python
+_dot = getattr(math, 'sumprod', None) or (lambda a, b: sum(map(mul, a, b)))
+
+
+class VectorIndex:
+    """Unit-length float32 vectors searched by dot product (cosine similarity)"""
+
+    def __init__(self, initial_capacity=256):
+        self.dim = None
+        self.count = 0
+        self._capacity = initial_capacity
+        self._matrix = None  # NumPy: (capacity, dim) array, rows [0, count) in use
+        self._rows = []  # Fallback: one array('f') per vector
+
+    @property
+    def nbytes(self):
+        return self.count * (self.dim or 0) * 4
+
+    @staticmethod
+    def prepare(values):
+        """Convert a raw embedding to the index's unit-length vector type"""
+        if numpy is not None:
+            vector = numpy.asarray(values, dtype=numpy.float32)
+            norm = float(numpy.linalg.norm(vector))
+            return vector / norm if norm else vector
+        norm = math.sqrt(sum(x * x for x in values))
+        return array('f', (x / norm for x in values) if norm else values)
+
+    def add(self, vector):
+        """Append a vector and return its row"""
+        if self.dim is None:
+            self.dim = len(vector)
+        if numpy is not None:
+            if self._matrix is None or self.count == len(self._matrix):
+                grown = numpy.empty((max(self._capacity, self.count * 2), self.dim), dtype=numpy.float32)
+                if self._matrix is not None:
+                    grown[:self.count] = self._matrix[:self.count]
+                self._matrix = grown
+            self._matrix[self.count] = vector
+        else:
+            self._rows.append(vector)
+        self.count += 1
+        return self.count - 1
+
+    def remove(self, row):
+        """Delete a row by moving the last row into its place; returns the moved row's old index"""
+        last = self.count - 1
+        if numpy is not None:
+            self._matrix[row] = self._matrix[last]
+        else:
+            self._rows[row] = self._rows[last]
+            self._rows.pop()
+        self.count -= 1
+        return last
+
+    def search(self, vector):
+        """Return (row, similarity) of the closest vector, or (None, 0.0) if empty"""
+        if not self.count or len(vector) != self.dim:
+            return None, 0.0
+        if numpy is not None:
+            scores = self._matrix[:self.count] @ vector
+            row = int(scores.argmax())
+            return row, float(scores[row])
+        best, best_row = -2.0, None
+        for row, candidate in enumerate(self._rows):
+            similarity = _dot(candidate, vector)
+            if similarity > best:
+                best, best_row = similarity, row
+        return best_row, best
+
+    def clear(self):
+        self.dim = None
+        self.count = 0
+        self._matrix = None
+        self._rows = []
+
+
+class Entry:
+    """One cached reply and where its vector is"""
+
+    __slots__ = ('chat_model', 'row', 'reply', 'nbytes', 'expires')
+
+    def __init__(self, chat_model, row, reply, expires):
+        self.chat_model = chat_model
+        self.row = row
+        self.expires = expires
+        self.set_reply(reply)
+
+    def set_reply(self, reply):
+        self.reply = reply
+        # Encoded size, so non-ASCII replies count what they really take
+        self.nbytes = len(reply.encode())
+
+
+class Partition:
+    """The vectors and entries for one chat model's replies"""
+
+    def __init__(self):
+        self.index = VectorIndex()
+        # Kept parallel to the index rows
+        self.entries = []
+
+    def remove(self, row):
+        moved = self.index.remove(row)
+        self.entries[row] = self.entries[moved]
+        self.entries[row].row = row
+        self.entries.pop()
+
+
+class SemanticCache:
+    """Replies keyed by prompt embedding, returned for prompts at least threshold-similar
+
+    Each chat model's replies are kept in their own partition, so a prompt
+    only matches replies from the model it will be sent to. Entries are
+    evicted least recently used first (across models) once there are more
+    than max_entries or their vectors and replies exceed max_memory_mb.
+    slot, if given, is called with a user id for a context manager that holds
+    a generation slot (GenerationScheduler.slot) around each embedding.
+    """
+
+    def __init__(self, ollama, model, threshold=0.95, max_entries=5000, max_memory_mb=64,
+                 ttl_seconds=86400, timing_window=200, slot=None):
+        self.ollama = ollama
+        self.model = model
+        self.slot = slot or (lambda user_id: nullcontext())
+        self.threshold = threshold
+        if numpy is None and max_entries > FALLBACK_MAX_ENTRIES:
+            print(f"⚠️ NumPy is not installed; semantic cache limited to {FALLBACK_MAX_ENTRIES} entries")
+            max_entries = FALLBACK_MAX_ENTRIES
+        self.max_entries = max_entries
+        self.max_bytes = max_memory_mb * 1024 * 1024
+        self.ttl_seconds = ttl_seconds
+        self._partitions = {}  # chat model -> Partition
+        # Every Entry, least recently used first and soonest to expire first (the TTL is fixed)
+        self._lru = OrderedDict()
+        self._expiry = OrderedDict()
+        self._reply_bytes = 0
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._embed_times = deque(maxlen=timing_window)
+        self._search_times = deque(maxlen=timing_window)
+        self._counters = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'errors': 0}
+
+    def _embed(self, text, user_id=None):
+        """Return the index vector for normalized prompt text"""
+        started = time.perf_counter()
+        with self.slot(user_id):
+            response = self.ollama.embed({'model': self.model, 'input': text})
+        response.raise_for_status()
+        vector = VectorIndex.prepare(response.json()['embeddings'][0])
+        with self._lock:
+            self._embed_times.append(time.perf_counter() - started)
+        return vector
+
+    def _count(self):
+        return len(self._lru)
+
+    def _nbytes(self):
+        return sum(partition.index.nbytes for partition in self._partitions.values()) + self._reply_bytes
+
+    def get(self, prompt, chat_model, user_id=None):
+        """Return chat_model's cached reply for the closest similar prompt, or None"""
+        text = normalize_prompt(prompt)
+        try:
+            vector = self._embed(text, user_id)
+        except Exception as e:
+            print(f"⚠️ Semantic cache lookup failed: {e}")
+            with self._lock:
+                self._counters['errors'] += 1
+            return None
+
+        now = time.time()
+        with self._lock:
+            self._pending[text] = vector
+            while len(self._pending) > PENDING_EMBEDDINGS:
+                self._pending.popitem(last=False)
+
+            partition = self._partitions.get(chat_model)
+            started = time.perf_counter()
+            row, similarity = partition.index.search(vector) if partition else (None, 0.0)
+            self._search_times.append(time.perf_counter() - started)
+            entry = partition.entries[row] if row is not None else None
+            if entry is None or similarity < self.threshold or entry.expires <= now:
+                self._counters['misses'] += 1
+                return None
+            self._lru.move_to_end(entry)
+            self._counters['hits'] += 1
+            reply = entry.reply
+        print(f"🧠 Semantic cache hit (similarity {similarity:.3f})")
+        return reply
+
+    def put(self, prompt, reply, chat_model, user_id=None):
+        """Cache a reply chat_model gave under its prompt's embedding"""
+        text = normalize_prompt(prompt)
+        with self._lock:
+            vector = self._pending.pop(text, None)
+        if vector is None:
+            try:
+                vector = self._embed(text, user_id)
+            except Exception as e:
+                print(f"⚠️ Semantic cache store failed: {e}")
+                with self._lock:
+                    self._counters['errors'] += 1
+                return
+
+        now = time.time()
+        with self._lock:
+            if any(p.index.count and len(vector) != p.index.dim for p in self._partitions.values()):
+                # The embedding model changed; old vectors can't be compared
+                self._clear()
+            partition = self._partitions.setdefault(chat_model, Partition())
+            row, similarity = partition.index.search(vector)
+            if row is not None and similarity >= self.threshold:
+                # Same question again (e.g. the entry expired): refresh it in place
+                entry = partition.entries[row]
+                self._reply_bytes -= entry.nbytes
+                entry.set_reply(reply)
+                entry.expires = now + self.ttl_seconds
+                self._lru.move_to_end(entry)
+                self._expiry.move_to_end(entry)
+            else:
+                entry = Entry(chat_model, partition.index.add(vector), reply, now + self.ttl_seconds)
+                partition.entries.append(entry)
+                self._lru[entry] = None
+                self._expiry[entry] = None
+            self._reply_bytes += entry.nbytes
+            self._counters['stores'] += 1
+            self._evict(now)
+
+    def _evict(self, now):
+        """Drop entries until within both caps, expired ones first (lock held)"""
+        while self._lru and (len(self._lru) > self.max_entries or self._nbytes() > self.max_bytes):
+            victim = next(iter(self._expiry))
+            if victim.expires > now:
+                victim = next(iter(self._lru))
+            self._partitions[victim.chat_model].remove(victim.row)
+            del self._lru[victim]
+            del self._expiry[victim]
+            self._reply_bytes -= victim.nbytes
+            self._counters['evictions'] += 1
+
+    def _clear(self):
+        self._partitions = {}
+        self._lru = OrderedDict()
+        self._expiry = OrderedDict()
+        self._reply_bytes = 0
+
+    def stats(self):
+        """Hit rate, size and embedding/search latency for this process"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update({
+                'entries': self._count(),
+                'entries_by_model': {model: p.index.count for model, p in self._partitions.items()},
+                'memory_mb': round(self._nbytes() / (1024 * 1024), 3),
+                'threshold': self.threshold,
+                'model': self.model,
+                'search_backend': 'numpy' if numpy is not None else 'python',
+            })
+            embed_times = list(self._embed_times)
+            search_times = list(self._search_times)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        if embed_times:
+            stats['embed_ms_p50'] = percentile_ms(embed_times, 0.50)
+            stats['embed_ms_p99'] = percentile_ms(embed_times, 0.99)
+        if search_times:
+            stats['search_ms_p50'] = percentile_ms(search_times, 0.50)
+            stats['search_ms_p99'] = percentile_ms(search_times, 0.99)
+        return stats
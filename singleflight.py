@@ -0,0 +1,128 @@
+"""
+Single-flight coalescing of identical generations
+Concurrent requests with the same key share one upstream generation: the first
+caller (the leader) runs it and every other caller replays its tokens as they
+arrive, so streaming followers see the reply at the same pace as the leader.
+"""
+
+import threading
+
+
+class Flight:
+    """One in-progress generation and the tokens produced so far"""
+
+    def __init__(self):
+        self.tokens = []
+        self.result = {}
+        self.done = False
+        # The exception that ended the leader's generation, re-raised for followers
+        self.error = None
+        self.waiters = 0
+        self.cond = threading.Condition()
+
+    def publish(self, token):
+        with self.cond:
+            self.tokens.append(token)
+            self.cond.notify_all()
+
+    def finish(self):
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+
+
+class SingleFlight:
+    """Deduplicates concurrent generations by key within a process"""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._counters = {'leaders': 0, 'deduplicated': 0}
+
+    def stream(self, key, start, result=None):
+        """Yield the tokens for key, starting the generation only if none is running
+
+        start(result) must return a token iterator and fill result with the
+        final generation details; it is only called by the leader. Once the
+        stream is exhausted, result (if given) receives the leader's details.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+                self._counters['leaders'] += 1
+            else:
+                self._counters['deduplicated'] += 1
+                with flight.cond:
+                    flight.waiters += 1
+
+        if leader:
+            yield from self._lead(key, flight, start)
+        else:
+            yield from self._follow(flight)
+        if result is not None:
+            result.update(flight.result)
+
+    def call(self, key, generate, result=None):
+        """Non-streaming variant: generate(result) returns the whole reply"""
+        return ''.join(self.stream(key, lambda r: iter([generate(r)]), result))
+
+    def _lead(self, key, flight, start):
+        tokens = None
+        finished = False
+        try:
+            # Inside the try: call()'s start generates eagerly and may raise
+            tokens = start(flight.result)
+            for token in tokens:
+                flight.publish(token)
+                yield token
+            finished = True
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            # Stop accepting followers before deciding whether anyone still needs this flight
+            with self._lock:
+                self._flights.pop(key, None)
+            try:
+                if not finished and tokens is not None:
+                    with flight.cond:
+                        waiting = flight.waiters
+                    if waiting:
+                        # Our own client went away; finish the generation for the others
+                        for token in tokens:
+                            flight.publish(token)
+                    elif hasattr(tokens, 'close'):
+                        tokens.close()
+            finally:
+                flight.finish()
+
+    def _follow(self, flight):
+        index = 0
+        try:
+            while True:
+                with flight.cond:
+                    while index >= len(flight.tokens) and not flight.done:
+                        flight.cond.wait()
+                    new_tokens = flight.tokens[index:]
+                    done = flight.done
+                for token in new_tokens:
+                    yield token
+                index += len(new_tokens)
+                if done and index >= len(flight.tokens):
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+        finally:
+            with flight.cond:
+                flight.waiters -= 1
+
+    def stats(self):
+        """Leader/deduplicated counts for this process"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['in_flight'] = len(self._flights)
+        total = stats['leaders'] + stats['deduplicated']
+        stats['dedup_rate'] = round(stats['deduplicated'] / total, 3) if total else 0.0
+        return stats
@@ -0,0 +1,196 @@
+"""
+Group-commit write-behind buffer
+Writes are queued and a single writer thread applies them in batched
+transactions, flushing when a batch is full or its oldest write has waited
+long enough. One commit then covers many chat turns, so bursts don't queue
+on SQLite's single write lock. Readers call flush() for the session or user
+they are about to read so they always see their own writes.
+"""
+
+import atexit
+import queue
+import threading
+import time
+from collections import Counter, deque
+
+from background import BackgroundThreads
+
+# Queue marker asking the writer to commit what it has collected right away
+_FLUSH = object()
+_STOP = object()
+
+
+class WriteTicket:
+    """Handle for one queued write; wait() returns its result once committed"""
+
+    def __init__(self, fn, session_id, user_id, urgent):
+        self.fn = fn
+        self.urgent = urgent
+        self.session_id = session_id
+        self.user_id = user_id
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """Block until the write is committed; raises if it failed"""
+        if not self._done.wait(timeout):
+            raise TimeoutError('Write was not committed in time')
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class WriteBehindBuffer:
+    """Single writer thread applying queued writes in group commits
+
+    synchronous optionally sets the writer connection's PRAGMA synchronous,
+    e.g. 'FULL' to fsync every batch instead of relying on WAL checkpoints.
+    """
+
+    def __init__(self, db, max_batch=64, max_delay=0.02, synchronous=None, timing_window=200):
+        self.db = db
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.synchronous = synchronous
+        self._queue = queue.Queue()
+        self._threads = BackgroundThreads([('write-behind', self._run)])
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._pending_sessions = Counter()
+        self._pending_users = Counter()
+        self._batches = deque(maxlen=timing_window)  # (entries, commit seconds)
+        self._counters = {'writes': 0, 'batches': 0, 'errors': 0}
+        # Once per buffer: close() finds whichever process's writer is running at exit
+        atexit.register(self.close)
+
+    def start(self):
+        """Start the writer thread in this process if it isn't running"""
+        self._threads.start()
+
+    def submit(self, fn, session_id=None, user_id=None, urgent=False):
+        """Queue fn(cursor) to run in a future batch and return its ticket
+
+        Pass urgent=True when the caller will wait() for the commit: its batch
+        is then committed with whatever is already queued instead of lingering
+        for max_delay, since the writers it would wait for are blocked on it.
+        """
+        self.start()
+        ticket = WriteTicket(fn, session_id, user_id, urgent)
+        with self._lock:
+            self._pending_sessions[session_id] += 1
+            self._pending_users[user_id] += 1
+        self._queue.put(ticket)
+        return ticket
+
+    def flush(self, session_id=None, user_id=None, timeout=10.0):
+        """Wait until queued writes for a session or user (or all, if neither) are committed"""
+        def settled():
+            if session_id is not None:
+                return self._pending_sessions[session_id] == 0
+            if user_id is not None:
+                return self._pending_users[user_id] == 0
+            return not self._pending_sessions
+
+        with self._lock:
+            if settled():
+                return
+        # Don't make the reader wait out max_delay
+        self._queue.put(_FLUSH)
+        with self._cond:
+            self._cond.wait_for(settled, timeout)
+
+    def close(self):
+        """Commit everything still queued and stop the writer (called at exit)"""
+        threads = self._threads.running()
+        if threads:
+            self._queue.put(_STOP)
+            threads[0].join()
+
+    def _run(self):
+        if self.synchronous:
+            self.db.execute(f'PRAGMA synchronous={self.synchronous}')
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            if item is _FLUSH:
+                continue
+
+            batch = [item]
+            urgent = item.urgent
+            deadline = time.monotonic() + self.max_delay
+            stop = False
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=0 if urgent else max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is _FLUSH:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+                urgent = urgent or item.urgent
+
+            self._commit(batch)
+            if stop:
+                return
+
+    def _commit(self, batch):
+        """Apply a batch in one transaction, retrying writes one by one if it fails"""
+        started = time.perf_counter()
+        try:
+            with self.db.transaction() as cursor:
+                results = [ticket.fn(cursor) for ticket in batch]
+        except Exception as e:
+            print(f"⚠️ Batched write of {len(batch)} failed ({e}), retrying individually")
+            for ticket in batch:
+                try:
+                    with self.db.transaction() as cursor:
+                        result = ticket.fn(cursor)
+                except Exception as single_error:
+                    print(f"❌ Write-behind error: {single_error}")
+                    self._settle(ticket, error=single_error)
+                else:
+                    self._settle(ticket, result)
+        else:
+            for ticket, result in zip(batch, results):
+                self._settle(ticket, result)
+
+        with self._lock:
+            self._counters['batches'] += 1
+            self._batches.append((len(batch), time.perf_counter() - started))
+
+    def _settle(self, ticket, result=None, error=None):
+        ticket.finish(result, error)
+        with self._cond:
+            self._counters['writes'] += 1
+            if error is not None:
+                self._counters['errors'] += 1
+            for pending, key in ((self._pending_sessions, ticket.session_id), (self._pending_users, ticket.user_id)):
+                pending[key] -= 1
+                if pending[key] <= 0:
+                    del pending[key]
+            self._cond.notify_all()
+
+    def stats(self):
+        """Batch sizes and commit times for this process"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['pending'] = sum(self._pending_sessions.values())
+            batches = list(self._batches)
+        if batches:
+            sizes = sorted(size for size, _ in batches)
+            times = sorted(seconds for _, seconds in batches)
+            stats['batch_size_avg'] = round(sum(sizes) / len(sizes), 2)
+            stats['batch_size_max'] = sizes[-1]
+            stats['batch_ms_p50'] = round(times[len(times) // 2] * 1000, 3)
+            stats['batch_ms_p99'] = round(times[min(len(times) - 1, int(len(times) * 0.99))] * 1000, 3)
+        return stats